@@ -0,0 +1,368 @@
+"""
+Microbenchmarks of every stage of a question, for each test type.
+
+Times generate_problem, generate_right_answer, generate_wrong_answers, render_problem, render_answer,
+render_answers (all answers of a question in one go) and the PIL to ImageTk.PhotoImage conversion separately, over a grid of test settings, and writes the
+results as JSON with percentiles so runs can be compared.
+
+    python benchmark.py --repeat 50 --out results.json
+    python benchmark.py --repeat 50 --out new.json --compare results.json
+    python benchmark.py --imports
+
+--imports checks the time it takes to import each module against IMPORT_BUDGETS, and that importing it
+does not load any of HEAVY_MODULES. Those are only imported once something needs them (a matplotlib renderer,
+a Tk window, ...).
+
+--exact checks that the fast exact arithmetic still gives exact results, so tuning it for speed can't quietly
+break it: determinanttest.bareiss_determinants against Fraction elimination, and every method of
+convolutiontest.batch_convolve2d against scipy's convolve2d.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import PIL
+
+STAGES = ['generate_problem', 'generate_right_answer', 'generate_wrong_answers',
+          'render_problem', 'render_answer', 'render_answers', 'photo_image']
+
+# Seconds each module may take to import in a fresh interpreter, numpy and PIL included
+IMPORT_BUDGETS = {'studenttest': 0.5, 'convolutiontest': 0.5, 'matrixmultiplytest': 0.5, 'determinanttest': 0.5,
+                  'problembank': 0.5, 'export': 0.5, 'webserve': 0.6, 'generate': 0.5}
+HEAVY_MODULES = ['matplotlib', 'scipy', 'tkinter']
+
+IMPORT_TIMER = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'heavy': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def summarize(times):
+    """
+    Returns count, mean, min, max and percentiles of a list of times in seconds, in milliseconds.
+    """
+    ms = np.array(times) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99]).tolist()
+    return {'count': len(ms), 'mean_ms': float(ms.mean()), 'min_ms': float(ms.min()),
+            'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'max_ms': float(ms.max())}
+
+
+def make_photo_image():
+    """
+    Returns a function that converts a PIL Image to an ImageTk.PhotoImage, or None if Tk has no display here.
+    """
+    try:
+        import tkinter as tk
+        from PIL import ImageTk
+        root = tk.Tk()
+        root.withdraw()
+    except Exception:
+        return None
+    return lambda image: ImageTk.PhotoImage(image, master=root)
+
+
+def benchmark_test(test, repeat=50, warmup=3, problem_kwargs=None, photo_image=None):
+    """
+    Run repeat questions through test, timing every stage. The first warmup questions are not counted,
+    so building renderers and caches does not show up in the results.
+    render_answer and photo_image are timed once per answer.
+    Returns a dict of stage -> summary, see summarize.
+    """
+    problem_kwargs = problem_kwargs or {}
+    times = {stage: [] for stage in STAGES}
+
+    def timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        times[stage].append(time.perf_counter() - start)
+        return result
+
+    for i in range(warmup + repeat):
+        if i == warmup:
+            times = {stage: [] for stage in STAGES}
+
+        timed('generate_problem', test.generate_problem, **problem_kwargs)
+        timed('generate_right_answer', test.generate_right_answer)
+        timed('generate_wrong_answers', test.generate_wrong_answers)
+        answers = [test.right_answer] + test.wrong_answers
+        images = [timed('render_problem', test.render_problem)]
+        for answer in answers:
+            images.append(timed('render_answer', test.render_answer, answer))
+        timed('render_answers', test.render_answers, answers)
+        if photo_image is not None:
+            for image in images:
+                timed('photo_image', photo_image, image)
+
+    return {stage: summarize(stage_times) for stage, stage_times in times.items() if stage_times}
+
+
+def measure_import(module, runs=3):
+    """
+    Import module in fresh interpreters, runs times.
+    Returns the fastest import time in seconds and the heavy modules the import loaded.
+    """
+    code = IMPORT_TIMER.format(module=module, heavy=HEAVY_MODULES)
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = [json.loads(subprocess.run([sys.executable, '-c', code], cwd=here, capture_output=True,
+                                         text=True, check=True).stdout) for _ in range(runs)]
+    return min(result['seconds'] for result in results), results[0]['heavy']
+
+
+def check_imports(budgets=IMPORT_BUDGETS, runs=3):
+    """
+    Measure the import time of every module in budgets.
+    Returns one dict per module, with 'ok' False if it is over budget or loads a heavy module.
+    """
+    results = []
+    for module, budget in budgets.items():
+        seconds, heavy = measure_import(module, runs)
+        results.append({'module': module, 'seconds': seconds, 'budget': budget, 'heavy': heavy,
+                        'ok': seconds <= budget and not heavy})
+    return results
+
+
+def fraction_determinant(matrix):
+    """
+    Determinant of a matrix (nested lists of ints) by Gaussian elimination over Fractions. Slow, but exact.
+    """
+    from fractions import Fraction
+    rows = [[Fraction(int(x)) for x in row] for row in matrix]
+    n = len(rows)
+    determinant = Fraction(1)
+    for k in range(n):
+        pivot = next((i for i in range(k, n) if rows[i][k] != 0), None)
+        if pivot is None:
+            return 0
+        if pivot != k:
+            rows[k], rows[pivot] = rows[pivot], rows[k]
+            determinant = -determinant
+        determinant *= rows[k][k]
+        for i in range(k + 1, n):
+            factor = rows[i][k] / rows[k][k]
+            for j in range(k, n):
+                rows[i][j] -= factor * rows[k][j]
+    return int(determinant)
+
+
+def check_determinants(sizes=(1, 2, 3, 4, 6, 12, 16), count=100, seed=0):
+    """
+    Compare bareiss_determinants with fraction_determinant on random matrices of every size, with entries in
+    the range DeterminantTest uses and some forced zero columns and dependent rows.
+    Returns one dict per size, with the number of wrong determinants.
+    """
+    from determinanttest import ENTRY_HIGH, ENTRY_LOW, bareiss_determinants
+    rng = np.random.default_rng(seed)
+    results = []
+    for size in sizes:
+        matrices = rng.integers(ENTRY_LOW, ENTRY_HIGH + 1, size=(count, size, size))
+        matrices[1::5, :, 0] = 0
+        if size > 1:
+            matrices[::4, 0] = 2 * matrices[::4, 1]
+        determinants = bareiss_determinants(matrices)
+        wrong = sum(int(d) != fraction_determinant(m.tolist()) for d, m in zip(determinants, matrices))
+        results.append({'check': f'bareiss_determinants {size}x{size}', 'wrong': wrong, 'ok': wrong == 0})
+    return results
+
+
+def convolution_check_cases(cases, seed):
+    """
+    Yields (images, filters) for check_convolutions: cases random stacks of small float images of several sizes and
+    densities, with odd and even, square and rectangular filters, then a few large dense images, float and integer.
+    """
+    rng = np.random.default_rng(seed)
+    for _ in range(cases):
+        height, width = rng.integers(1, 40, size=2)
+        kh, kw = rng.integers(1, 8, size=2)
+        count = rng.integers(1, 5)
+        density = rng.choice([0.01, 0.1, 0.5, 1.0])
+        images = (rng.random((count, height, width)) < density) * rng.integers(-3, 4, size=(count, height, width))
+        yield images.astype(float), rng.integers(-2, 3, size=(count, kh, kw))
+    for height, width, kh, kw, dtype in [(1200, 1100, 3, 3, float), (1100, 1200, 4, 5, int), (1000, 1000, 7, 7, float)]:
+        images = rng.integers(-3, 4, size=(1, height, width)).astype(dtype)
+        yield images, rng.integers(-2, 3, size=(1, kh, kw))
+
+
+def check_convolutions(cases=50, seed=0):
+    """
+    Compare every method of batch_convolve2d with scipy's convolve2d(mode='same'), values and dtype,
+    see convolution_check_cases. Returns one dict per method (and one for the automatic choice),
+    with the number of wrong cases.
+    """
+    from scipy.signal import convolve2d
+    from convolutiontest import batch_convolve2d
+    methods = ['stamp', 'direct', 'fft', 'convolve2d', None]
+    wrong = dict.fromkeys(methods, 0)
+    for images, filters in convolution_check_cases(cases, seed):
+        expected = np.array([convolve2d(image, filter, mode='same') for image, filter in zip(images, filters)])
+        for method in methods:
+            convolved = batch_convolve2d(images, filters, method=method)
+            if convolved.dtype != expected.dtype or not np.array_equal(convolved, expected):
+                wrong[method] += 1
+    return [{'check': f'batch_convolve2d method={method or "automatic"}', 'wrong': count, 'ok': count == 0}
+            for method, count in wrong.items()]
+
+
+def check_exact():
+    """
+    Run every exactness check. Returns one dict per check, see check_determinants.
+    """
+    return check_determinants() + check_convolutions()
+
+
+def convolution_cases(image_sizes, filter_sizes, dot_counts, backends):
+    """
+    Yields (name, params, make test, problem kwargs) for every ConvolutionTest setting.
+    """
+    from convolutiontest import ConvolutionTest
+    for mode, backend, image_size, filter_size, dot_count in itertools.product(
+            ['dot', 'pattern'], backends, image_sizes, filter_sizes, dot_counts):
+        params = {'mode': mode, 'backend': backend, 'image_size': image_size,
+                  'filter_size': filter_size, 'dot_count': dot_count}
+        yield ('ConvolutionTest', params,
+               lambda seed, mode=mode, backend=backend: ConvolutionTest(mode=mode, backend=backend, seed=seed),
+               {'filter_size': filter_size, 'image_size': image_size, 'pixel_count': dot_count})
+
+
+def matrix_cases(typesetters):
+    """
+    Yields (name, params, make test, problem kwargs) for every MatrixMultiplyTest setting.
+    """
+    from matrixmultiplytest import MatrixMultiplyTest
+    for mode, visual, typesetter in itertools.product(['shape_matching', 'shape_calculation'],
+                                                      ['numerical', 'dot'], typesetters):
+        params = {'mode': mode, 'visual': visual, 'typesetter': typesetter}
+        yield ('MatrixMultiplyTest', params,
+               lambda seed, mode=mode, visual=visual, typesetter=typesetter:
+                   MatrixMultiplyTest(mode=mode, visual=visual, typesetter=typesetter, seed=seed),
+               {})
+
+
+def run(cases, repeat=50, warmup=3, seed=0, photo=True, verbose=True):
+    """
+    Benchmark every case. A case that fails (say, LaTeX is not installed) is recorded with its error.
+    Returns the results as a JSON-ready dict.
+    """
+    photo_image = make_photo_image() if photo else None
+    results = []
+    for name, params, make_test, problem_kwargs in cases:
+        result = {'test': name, 'params': params}
+        try:
+            result['stages'] = benchmark_test(make_test(seed), repeat, warmup, problem_kwargs, photo_image)
+        except Exception as error:
+            result['error'] = f'{type(error).__name__}: {error}'
+        results.append(result)
+        if verbose:
+            print(format_result(result), flush=True)
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pillow': PIL.__version__,
+            'repeat': repeat,
+            'warmup': warmup,
+            'seed': seed,
+            'photo_image': photo_image is not None,
+        },
+        'results': results,
+    }
+
+
+def case_key(result):
+    return result['test'] + ' ' + ' '.join(f'{key}={value}' for key, value in result['params'].items())
+
+
+def format_result(result):
+    """
+    One line per case: the p50 of every stage.
+    """
+    if 'error' in result:
+        return f"{case_key(result)}: {result['error']}"
+    stages = ', '.join(f"{stage} {summary['p50_ms']:.2f}" for stage, summary in result['stages'].items())
+    return f"{case_key(result)}: p50 ms {stages}"
+
+
+def compare(baseline, results, threshold=1.1):
+    """
+    Compare the p50 of every stage against a baseline run.
+    Returns lines of the form "case stage: old -> new ms (ratio)", marking ratios above threshold as regressions.
+    """
+    old = {case_key(result): result.get('stages', {}) for result in baseline['results']}
+    lines = []
+    for result in results['results']:
+        key = case_key(result)
+        for stage, summary in result.get('stages', {}).items():
+            if stage not in old.get(key, {}):
+                continue
+            before, after = old[key][stage]['p50_ms'], summary['p50_ms']
+            ratio = after / before if before else float('inf')
+            flag = '  REGRESSION' if ratio > threshold else ''
+            lines.append(f'{key} {stage}: {before:.3f} -> {after:.3f} ms ({ratio:.2f}x){flag}')
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tests', nargs='+', default=['convolution', 'matrix'], choices=['convolution', 'matrix'])
+    parser.add_argument('--image-sizes', nargs='+', type=int, default=[20, 25])
+    parser.add_argument('--filter-sizes', nargs='+', type=int, default=[3, 4])
+    parser.add_argument('--dot-counts', nargs='+', type=int, default=[4, 8])
+    parser.add_argument('--backends', nargs='+', default=['matplotlib', 'numpy'], choices=['matplotlib', 'numpy'])
+    parser.add_argument('--typesetters', nargs='+', default=['latex', 'pil'], choices=['latex', 'pil'])
+    parser.add_argument('--repeat', type=int, default=50, help='questions timed per case')
+    parser.add_argument('--warmup', type=int, default=3, help='questions run first and not timed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-photo', action='store_true', help='skip timing the ImageTk.PhotoImage conversion')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file from an earlier run to compare against')
+    parser.add_argument('--imports', action='store_true', help='only check the import time budgets')
+    parser.add_argument('--exact', action='store_true', help='only check that the exact arithmetic is exact')
+    args = parser.parse_args(argv)
+
+    if args.exact:
+        results = check_exact()
+        for result in results:
+            print(f"{result['check']}: {'ok' if result['ok'] else 'WRONG'} ({result['wrong']} wrong)")
+        return 0 if all(result['ok'] for result in results) else 1
+
+    if args.imports:
+        results = check_imports()
+        for result in results:
+            heavy = f", loads {', '.join(result['heavy'])}" if result['heavy'] else ''
+            print(f"{result['module']}: {result['seconds']:.3f} s of {result['budget']:.3f} s{heavy}"
+                  f"{'' if result['ok'] else '  OVER BUDGET'}")
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump({'imports': results}, f, indent=2)
+        return 0 if all(result['ok'] for result in results) else 1
+
+    cases = []
+    if 'convolution' in args.tests:
+        cases += convolution_cases(args.image_sizes, args.filter_sizes, args.dot_counts, args.backends)
+    if 'matrix' in args.tests:
+        cases += matrix_cases(args.typesetters)
+
+    results = run(cases, repeat=args.repeat, warmup=args.warmup, seed=args.seed, photo=not args.no_photo)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\n'.join(compare(baseline, results)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
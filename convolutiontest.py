@@ -1,113 +1,705 @@
 import numpy as np
-import random
-import matplotlib.pyplot as plt
-from scipy.signal import convolve2d
+from PIL import Image, ImageDraw
 
-from time import time
+# scipy and matplotlib take seconds to import, so they are only loaded once they are needed
+from studenttest import StudentTest
+from rasterize import load_font, bordered_panel, atlas_tiles
+
+
+# Filters up to this size are drawn from a precomputed table, see filter_table
+FILTER_TABLE_MAX_SIZE = 4
+
+_filter_tables = {}
+
+
+def pack_filters(filters):
+    """
+    Pack an (n, k, k) stack of binary filters into uint16 bitmasks, with pixel (r, c) in bit r*k + c.
+    """
+    n = len(filters)
+    bits = np.asarray(filters).reshape(n, -1).astype(np.uint16)
+    return (bits << np.arange(bits.shape[1], dtype=np.uint16)).sum(axis=1, dtype=np.uint16)
+
+
+def filter_table(filter_size):
+    """
+    Returns every valid filter_size x filter_size filter (at least two black and two white pixels) as
+    - masks: sorted uint16 bitmasks, see pack_filters
+    - filters: the matching (M, k, k) uint8 arrays
+    Only for filter_size <= FILTER_TABLE_MAX_SIZE, so every filter fits in 16 bits. Built once per size.
+    """
+    if filter_size not in _filter_tables:
+        cells = filter_size * filter_size
+        masks = np.arange(2 ** cells, dtype=np.uint32)
+        bits = ((masks[:, None] >> np.arange(cells)) & 1).astype(np.uint8)
+        white_pixels = bits.sum(axis=1)
+        valid = (white_pixels >= 2) & (cells - white_pixels >= 2)
+        _filter_tables[filter_size] = (masks[valid].astype(np.uint16), bits[valid].reshape(-1, filter_size, filter_size))
+    return _filter_tables[filter_size]
+
+
+# Rough cost of each convolution method, in nanoseconds, see convolution_method
+STAMP_COST = 25.0               # per (dot, filter tap) pair
+SCAN_COST = 2.0                 # per pixel, finding the dots
+DIRECT_COST = 2.0               # per (pixel, filter tap) pair
+DIRECT_ROW_COST = 25.0          # per (image row, filter tap) pair
+FFT_COST = 4.0                  # per padded pixel and log2 of the padded size
+CONVOLVE2D_COST = 5.0           # per (pixel, filter tap) pair
+STAMP_OVERHEAD = 35000.0        # per call
+DIRECT_OVERHEAD = 50000.0
+FFT_OVERHEAD = 250000.0
+CONVOLVE2D_OVERHEAD = 25000.0   # per image
+DISPATCH_OVERHEAD = 20000.0     # looking at the images to pick a method
+
+# Working memory of a direct_convolve2d block, sized to stay in cache
+DIRECT_CHUNK_BYTES = 2 ** 18
+
+# FFT results are rounded back to integers, which is exact as long as they stay well below this
+FFT_EXACT_LIMIT = 2.0 ** 40
+
+
+def direct_convolve2d(images, filters, chunk_size=128, dtype=float):
+    """
+    Direct convolution of stacks of images and filters, see batch_convolve2d.
+    Every pair is convolved in one pass over the kh*kw filter offsets, and the sums are kept as dtype.
+    Works on up to chunk_size images at a time, and on blocks of rows of images larger than DIRECT_CHUNK_BYTES,
+    so apart from the result the memory used doesn't grow with the images.
+    """
+    kh, kw = filters.shape[-2:]
+    height, width = images.shape[-2:]
+    top, left = (kh - 1) // 2, (kw - 1) // 2  # Where convolve2d crops the 'full' output for 'same'
+
+    flat_images = images.reshape(-1, height, width)
+    flat_filters = filters.reshape(-1, kh, kw)
+    convolved = np.zeros(flat_images.shape, dtype)
+    row_bytes = max(1, width * convolved.itemsize)
+    chunk_size = max(1, min(chunk_size, len(flat_images), DIRECT_CHUNK_BYTES // (height * row_bytes)))
+    block_rows = height if chunk_size > 1 else max(1, min(height, DIRECT_CHUNK_BYTES // row_bytes))
+    product = np.empty((chunk_size, block_rows, width), dtype)
+
+    for chunk in range(0, len(flat_images), chunk_size):
+        chunk_filters = flat_filters[chunk:chunk + chunk_size]
+        for start in range(0, height, block_rows):
+            stop = min(start + block_rows, height)
+
+            # Output row r needs image rows r + top - kh + 1 to r + top, zero padded past the edges
+            low, high = start + top - kh + 1, stop + top
+            block = flat_images[chunk:chunk + chunk_size, max(low, 0):min(high, height)]
+            padded = np.pad(block, ((0, 0), (max(0, -low), max(0, high - height)), (kw - 1, kw - 1)))
+
+            out = convolved[chunk:chunk + chunk_size, start:stop]
+            block_product = product[:len(out), :stop - start]
+            for a in range(kh):
+                for b in range(kw):
+                    row = kh - 1 - a
+                    col = left + kw - 1 - b
+                    np.multiply(chunk_filters[:, a, b, None, None], padded[:, row:row + stop - start, col:col + width],
+                                out=block_product)
+                    out += block_product
+
+    return convolved.reshape(images.shape)
+
+
+def stamp_convolve2d(images, filters):
+    """
+    Convolution of stacks of mostly empty images and filters, see batch_convolve2d.
+    The result is the filter, scaled by the pixel value, stamped at every nonzero pixel,
+    so the work only grows with the number of nonzero pixels. Overlapping stamps are added up.
+    """
+    kh, kw = filters.shape[-2:]
+    height, width = images.shape[-2:]
+    top, left = (kh - 1) // 2, (kw - 1) // 2
+
+    flat_images = images.reshape(-1, height, width)
+    flat_filters = filters.reshape(-1, kh, kw)
+
+    # Much faster than np.nonzero on the 3d float array
+    index, rows, cols = np.unravel_index(np.flatnonzero(flat_images != 0), flat_images.shape)
+    values = flat_images[index, rows, cols][:, None, None] * flat_filters[index]
+
+    # Pixel (r, c) adds filter[a, b] to pixel (r + a, c + b) of the 'full' output, which has room for every stamp
+    full_height, full_width = height + kh - 1, width + kw - 1
+    positions = ((index[:, None, None] * full_height + rows[:, None, None] + np.arange(kh)[None, :, None]) * full_width
+                 + cols[:, None, None] + np.arange(kw)[None, None, :])
+    full = np.bincount(positions.ravel(), weights=values.ravel(), minlength=len(flat_images) * full_height * full_width)
+
+    # Crop it the way convolve2d does for 'same'
+    full = full.reshape(-1, full_height, full_width)
+    return np.ascontiguousarray(full[:, top:top + height, left:left + width]).reshape(images.shape)
+
+
+def fft_convolve2d(images, filters):
+    """
+    Convolution of stacks of images and filters with FFTs, see batch_convolve2d.
+    Uses overlap-add when the images are much larger than the filters. The result is rounded to integers.
+    """
+    from scipy.signal import fftconvolve, oaconvolve
+
+    kh, kw = filters.shape[-2:]
+    height, width = images.shape[-2:]
+    flat_images = images.reshape(-1, height, width)
+    flat_filters = filters.reshape(-1, kh, kw).astype(float)
+
+    convolve = oaconvolve if min(height, width) >= 8 * max(kh, kw) else fftconvolve
+    return np.round(convolve(flat_images, flat_filters, mode='same', axes=(1, 2))).reshape(images.shape)
+
+
+def integer_valued(array):
+    """
+    Returns True if every value of array is an integer.
+    """
+    return array.dtype.kind in 'biu' or bool(np.all(array == np.round(array)))
+
+
+def convolution_method(images, filters):
+    """
+    Pick the fastest exact way to convolve stacks of images and filters, see batch_convolve2d:
+    - 'stamp' for sparse images, like the dot images (stamp_convolve2d)
+    - 'direct' for dense images and small filters, even very large images (direct_convolve2d)
+    - 'fft' for large filters (fft_convolve2d)
+    - 'convolve2d' (scipy's, one pair at a time) for a few small images, and for images or filters that
+      aren't integer valued, as the other methods only give exactly the same sums for integers.
+    The choice comes from a rough cost model of each method.
+    """
+    kh, kw = filters.shape[-2:]
+    height, width = images.shape[-2:]
+    count = images.size // (height * width)
+    taps = kh * kw
+
+    # A single small convolution is done by convolve2d before the images could even be looked at
+    convolve2d_cost = count * CONVOLVE2D_OVERHEAD + CONVOLVE2D_COST * images.size * taps
+    if convolve2d_cost < STAMP_OVERHEAD + SCAN_COST * images.size + DISPATCH_OVERHEAD:
+        return 'convolve2d'
+
+    # Zeros are integers, so only the other values need checking
+    values = images[images != 0]
+    if not (integer_valued(values) and integer_valued(filters)):
+        return 'convolve2d'
+
+    costs = {'stamp': STAMP_OVERHEAD + STAMP_COST * len(values) * taps + SCAN_COST * images.size,
+             'direct': DIRECT_OVERHEAD + (DIRECT_COST * images.size + DIRECT_ROW_COST * count * height) * taps,
+             'convolve2d': convolve2d_cost}
+    padded = (height + kh - 1) * (width + kw - 1)
+    fft_cost = FFT_OVERHEAD + FFT_COST * count * padded * np.log2(padded)
+
+    # FFTs are only exact when every sum is small enough to round back correctly
+    if fft_cost < min(costs.values()) and np.abs(values).sum() * np.abs(filters).max() < FFT_EXACT_LIMIT:
+        return 'fft'
+    return min(costs, key=costs.get)
+
+
+def batch_convolve2d(images, filters, chunk_size=128, method=None):
+    """
+    Same as convolve2d(image, filter, mode='same'), for stacks of images and filters.
+    images has shape (..., H, W) and filters has shape (..., kh, kw), with matching leading dimensions.
+    method is one of 'stamp', 'direct', 'fft' or 'convolve2d'; by default convolution_method picks one.
+    The result is exactly what convolve2d returns, whatever the method, for integer valued images and filters.
+    """
+    if method is None:
+        method = convolution_method(images, filters)
+
+    # convolve2d returns the common type of its inputs
+    dtype = np.result_type(images, filters)
+    if method == 'stamp':
+        return stamp_convolve2d(images, filters).astype(dtype, copy=False)
+    if method == 'direct':
+        return direct_convolve2d(images, filters, chunk_size, dtype)
+    if method == 'fft':
+        return fft_convolve2d(images, filters).astype(dtype, copy=False)
+    if method == 'convolve2d':
+        from scipy.signal import convolve2d
+
+        flat_images = images.reshape(-1, *images.shape[-2:])
+        flat_filters = filters.reshape(-1, *filters.shape[-2:])
+        convolved = np.empty(flat_images.shape, dtype)
+        for i in range(len(flat_images)):
+            convolved[i] = convolve2d(flat_images[i], flat_filters[i], mode='same')
+        return convolved.reshape(images.shape)
+    raise ValueError("Invalid method. Choose 'stamp', 'direct', 'fft' or 'convolve2d'")
+
+
+class ConvolutionRenderer:
+    """
+    Draws the images for ConvolutionTest.
+    The figures, axes and borders are built once, rendering a new question only
+    swaps the image data in and redraws the images on top of a cached background.
+    """
+    def __init__(self):
+        from matplotlib.figure import Figure
+        from rendering import FigureBlitter
+
+        # Problem: filter and image side by side
+        self.problem_fig = Figure(figsize=(6, 3))
+        ax1, ax2 = self.problem_fig.subplots(1, 2)
+        self.filter_plot, filter_border = self.add_bordered_image(ax1, 'Filter')
+        self.image_plot, image_border = self.add_bordered_image(ax2, 'Image')
+        self.problem_fig.tight_layout()
+        self.problem_blitter = FigureBlitter(self.problem_fig, [self.filter_plot, filter_border, self.image_plot, image_border])
+
+        # Answer: a single convolved image, smaller
+        self.answer_fig = Figure(figsize=(2, 2))
+        ax = self.answer_fig.subplots()
+        self.answer_plot, answer_border = self.add_bordered_image(ax, 'Convolved Image', fontsize=8)
+        self.answer_fig.tight_layout()
+        self.answer_blitter = FigureBlitter(self.answer_fig, [self.answer_plot, answer_border])
+        self.answer_atlases = {}  # Number of answers -> (AxesImages, FigureBlitter), see answer_atlas
+
+    def add_bordered_image(self, ax, title, fontsize=None):
+        """
+        Set up ax to show a grayscale image with a title and a black border.
+        Returns the AxesImage, whose data gets replaced for every question, and the border,
+        which has to be drawn again on top of it.
+        """
+        from matplotlib import patches
 
+        plot = ax.imshow(np.zeros((1, 1)), cmap='gray', interpolation='nearest', vmin=0, vmax=1, extent=[0, 1, 0, 1])
+        if fontsize is None:
+            ax.set_title(title)
+        else:
+            ax.set_title(title, fontsize=fontsize)  # Adjust the fontsize of the title
+        ax.axis('off')
 
-import tkinter as tk
-from PIL import ImageTk, Image
-import random
-import matplotlib.patches as patches
-from collections import Counter
+        # Add a border around the plot
+        border_width = 2  # Adjust the border width as needed
+        border_color = 'black'  # Adjust the border color as needed
+        rect = patches.Rectangle((0, 0), 1, 1, linewidth=border_width, edgecolor=border_color, facecolor='none')
+        ax.add_patch(rect)
 
-from studenttest import StudentTest
+        return plot, rect
+
+    def render_problem(self, filter, image):
+        """
+        Returns a PIL Image of the filter and image side by side.
+        """
+        self.filter_plot.set_data(filter)
+        self.image_plot.set_data(image)
+        return self.problem_blitter.render()
+
+    def render_answer(self, answer):
+        """
+        Returns a PIL Image of a convolved image, scaled so its largest value is white.
+        """
+        self.answer_plot.set_data(answer)
+        self.answer_plot.set_clim(0, np.max(answer))
+        return self.answer_blitter.render()
+
+    def answer_atlas(self, count):
+        """
+        Returns the AxesImages and FigureBlitter of a figure with count answer layouts stacked top to bottom,
+        building it on first use. Every tile has exactly the layout of the single answer figure.
+        """
+        if count not in self.answer_atlases:
+            from matplotlib.figure import Figure
+            from rendering import FigureBlitter
+
+            x0, y0, width, height = self.answer_fig.axes[0].get_position().bounds
+            fig = Figure(figsize=(2, 2 * count))
+            plots, artists = [], []
+            for i in range(count):
+                ax = fig.add_axes([x0, (count - 1 - i + y0) / count, width, height / count])
+                plot, border = self.add_bordered_image(ax, 'Convolved Image', fontsize=8)
+                plots.append(plot)
+                artists += [plot, border]
+            self.answer_atlases[count] = (plots, FigureBlitter(fig, artists))
+        return self.answer_atlases[count]
+
+    def render_answers(self, answers):
+        """
+        Returns PIL Images of several convolved images, the same as render_answer on each of them.
+        They are all drawn in one figure, and the Images are views of one copy of its pixels.
+        """
+        plots, blitter = self.answer_atlas(len(answers))
+        for plot, answer in zip(plots, answers):
+            plot.set_data(answer)
+            plot.set_clim(0, np.max(answer))
+        return atlas_tiles(blitter.render_array(), len(answers))
+
+
+class ConvolutionRasterRenderer:
+    """
+    Draws the same layout as ConvolutionRenderer directly with NumPy and PIL, without matplotlib.
+    The titles are drawn once onto a background, rendering a question only
+    pastes the upscaled arrays into it. Images are grayscale ('L' mode).
+    """
+    # (left, top, size) of each bordered image, matching the matplotlib layout
+    problem_panels = [(25, 27, 258), (317, 27, 258)]
+    answer_panel = (24, 32, 152)
+
+    def __init__(self):
+        self.problem_background = self.titled_background((600, 300), ['Filter', 'Image'], self.problem_panels,
+                                                         load_font(17), baseline=17)
+        self.answer_background = self.titled_background((200, 200), ['Convolved Image'], [self.answer_panel],
+                                                        load_font(11), baseline=23)
+
+    def titled_background(self, size, titles, panels, font, baseline):
+        """
+        Returns a white uint8 canvas of the given (width, height), with each title centered above its panel.
+        """
+        background = Image.new('L', size, 255)
+        draw = ImageDraw.Draw(background)
+        for title, (left, top, panel_size) in zip(titles, panels):
+            draw.text((left + panel_size / 2, baseline), title, fill=0, font=font, anchor='ms')
+        return np.array(background)
+
+    def render_problem(self, filter, image):
+        """
+        Returns a PIL Image of the filter and image side by side.
+        """
+        canvas = self.problem_background.copy()
+        for array, (left, top, size) in zip([filter, image], self.problem_panels):
+            canvas[top:top + size, left:left + size] = bordered_panel(array, size, 0, 1)
+        return Image.fromarray(canvas)
+
+    def render_answer(self, answer):
+        """
+        Returns a PIL Image of a convolved image, scaled so its largest value is white.
+        """
+        canvas = self.answer_background.copy()
+        left, top, size = self.answer_panel
+        canvas[top:top + size, left:left + size] = bordered_panel(answer, size, 0, np.max(answer))
+        return Image.fromarray(canvas)
+
+    def render_answers(self, answers):
+        """
+        Returns PIL Images of several convolved images, the same as render_answer on each of them.
+        They are all drawn into one canvas, and the Images are views of it.
+        """
+        tile_height = self.answer_background.shape[0]
+        atlas = np.tile(self.answer_background, (len(answers), 1))
+        left, top, size = self.answer_panel
+        for i, answer in enumerate(answers):
+            top_i = i * tile_height + top
+            atlas[top_i:top_i + size, left:left + size] = bordered_panel(answer, size, 0, np.max(answer))
+        return atlas_tiles(atlas, len(answers))
 
 
 class ConvolutionTest(StudentTest):
-    def __init__(self, max_streak=10, mode='dot'):
-        """mode given as either 'dot or 'pattern' """
-        super().__init__(max_streak)
+    BANK_PARAMS = ['mode', 'backend']
+
+    def __init__(self, max_streak=10, mode='dot', backend='matplotlib', seed=None):
+        """
+        mode given as either 'dot or 'pattern'
+        backend given as either 'matplotlib' or 'numpy' (draws the same images without matplotlib)
+        seed: optional root seed for the random stream, see StudentTest
+        """
+        super().__init__(max_streak, seed)
         if mode not in ['dot', 'pattern']:
             raise ValueError("Invalid mode. Choose 'dot' or 'pattern'")
+        if backend not in ['matplotlib', 'numpy']:
+            raise ValueError("Invalid backend. Choose 'matplotlib' or 'numpy'")
         self.mode = mode
-        self.image_num = 0
+        self.backend = backend
 
     def generate_dot_image(self, image_size, pixel_count, filter, old_image=None):
         """
         Generate an image with randomly placed pixels, excluding pixels too close to each other and the edges.
         Returns the generated image.
         """
-        filter_shape = filter.shape
-        seed = int(time()) + self.image_num
-        random.seed(seed)
-        self.image_num += 1
-        image = np.zeros((image_size, image_size))
-        
-        # Define a buffer to avoid placing pixels at the edges
-        buffer = max(filter_shape)
-        possible_pixels = {(i, j) for i in range(buffer, image_size - buffer) for j in range(buffer, image_size - buffer)}
-        
-        selected_pixels = set()
-        while len(selected_pixels) < pixel_count and possible_pixels:
-            # Randomly select a pixel from the possible pixels
-            pixel = random.choice(list(possible_pixels))
-            selected_pixels.add(pixel)
-
-            # Store pixels that are too close to the selected pixel in a separate set
-            pixels_to_remove = set()
-            for i in range(max(buffer, pixel[0] - filter_shape[0] + 1), min(image_size - buffer, pixel[0] + filter_shape[0])):
-                for j in range(max(buffer, pixel[1] - filter_shape[1] + 1), min(image_size - buffer, pixel[1] + filter_shape[1])):
-                    if (i, j) in possible_pixels:
-                        pixels_to_remove.add((i, j))
-
-            # Remove pixels that are too close to the selected pixel from possible_pixels
-            possible_pixels -= pixels_to_remove
-
-        # Set the selected pixels to 1 in the image
-        for pixel in selected_pixels:
-            image[pixel] = 1
-
-        if old_image is not None:
+        while True:
+            image = np.zeros((image_size, image_size))
+            for pixel in self.sample_dots(image_size, pixel_count, filter.shape):
+                image[pixel] = 1
+
             # Used if we want to avoid a duplicate image
-            if np.array_equal(old_image, image):
-                return self.generate_dot_image(image_size, pixel_count, filter, old_image=old_image)
+            if old_image is None or not np.array_equal(old_image, image):
+                return image
+
+    def sample_dots(self, image_size, pixel_count, filter_shape, max_misses=30):
+        """
+        Pick up to pixel_count pixels uniformly at random, at least max(filter_shape) pixels away from the edges,
+        and with no two pixels closer than the filter size in both directions.
+        Returns the pixels as a list of (row, col).
+
+        Pixels are thrown at random and kept if no earlier pixel is too close (the same as picking uniformly
+        among the pixels still available). Kept pixels go in a grid with filter-sized cells, so each cell holds
+        at most one pixel and a throw only has to check the neighbouring cells. This costs O(1) per pixel.
+        If max_misses throws in a row are rejected the image is nearly full, and the remaining pixels are
+        picked exactly from a mask of the available pixels instead.
+        """
+        rows, cols = filter_shape
+        buffer = max(filter_shape)
+        low, high = buffer, image_size - buffer  # Allowed rows/cols are low..high-1
+        if high <= low:
+            return []
+
+        grid = {}  # (cell row, cell col) -> pixel
+        misses = 0
+        throws = []
+        while len(grid) < pixel_count:
+            if misses >= max_misses:
+                return self.fill_dots(image_size, pixel_count, filter_shape, list(grid.values()))
+
+            # Draw throws from the random stream in blocks, it is much cheaper than one at a time
+            if not throws:
+                throws = self.rng.integers(low, high, size=(2 * int(pixel_count) + max_misses, 2)).tolist()
+            i, j = throws.pop()
+            cell_i = (i - low) // rows
+            cell_j = (j - low) // cols
+
+            too_close = False
+            for di in (-1, 0, 1):
+                for dj in (-1, 0, 1):
+                    other = grid.get((cell_i + di, cell_j + dj))
+                    if other is not None and abs(other[0] - i) < rows and abs(other[1] - j) < cols:
+                        too_close = True
+            if too_close:
+                misses += 1
+                continue
+
+            grid[(cell_i, cell_j)] = (i, j)
+            misses = 0
+
+        return list(grid.values())
+
+    def fill_dots(self, image_size, pixel_count, filter_shape, pixels):
+        """
+        Add pixels to pixels until there are pixel_count or no space is left, following the rules of sample_dots.
+        For nearly full images: the available pixels are listed once, and every new pixel removes its neighbours
+        from the list (swapping the last one into their place), so each pixel costs O(filter size^2).
+        """
+        rows, cols = filter_shape
+        buffer = max(filter_shape)
+        available = np.zeros((image_size, image_size), dtype=bool)
+        available[buffer:image_size - buffer, buffer:image_size - buffer] = True
+        for i, j in pixels:
+            available[max(0, i - rows + 1):i + rows, max(0, j - cols + 1):j + cols] = False
+
+        candidates = np.flatnonzero(available).tolist()
+        position = np.full(image_size * image_size, -1, dtype=np.int64)  # Index of a pixel in candidates, or -1
+        position[candidates] = np.arange(len(candidates))
+        position = position.tolist()
+
+        def remove_neighbours(i, j):
+            for ni in range(max(0, i - rows + 1), min(image_size, i + rows)):
+                for nj in range(max(0, j - cols + 1), min(image_size, j + cols)):
+                    index = position[ni * image_size + nj]
+                    if index < 0:
+                        continue
+                    last = candidates.pop()
+                    if index < len(candidates):
+                        candidates[index] = last
+                        position[last] = index
+                    position[ni * image_size + nj] = -1
+
+        pixels = list(pixels)
+        while len(pixels) < pixel_count and candidates:
+            i, j = divmod(candidates[self.rng.integers(len(candidates))], image_size)
+            pixels.append((i, j))
+            remove_neighbours(i, j)
+
+        return pixels
 
-        return image
-    
     def generate_pattern_image(self, dot_image, filter):
         """
         Generate a pattern image by placing the filter over the pixels surrounding
         the modified pixels in the dot image.
         Returns the generated pattern image.
         """
-        filter_shape = filter.shape
-        pattern_image = np.zeros(dot_image.shape)
-        image_size = dot_image.shape[0]
+        return self.generate_pattern_images(dot_image[None], filter[None])[0]
 
-        for i in range(image_size):
-            for j in range(image_size):
-                if dot_image[i, j] == 1:
-                    start_row = max(0, i - filter_shape[0] // 2)
-                    end_row = min(image_size, start_row + filter_shape[0])
-                    start_col = max(0, j - filter_shape[1] // 2)
-                    end_col = min(image_size, start_col + filter_shape[1])
-
-                    pattern_image[start_row:end_row, start_col:end_col] = filter
-
-        return pattern_image
+    def generate_pattern_images(self, dot_images, filters):
+        """
+        Batched generate_pattern_image, for an (n, S, S) stack of dot images and an (n, k, k) stack of filters.
+        The dots are found with np.nonzero and every filter is stamped in a single fancy-indexed assignment.
+        Returns the (n, S, S) stack of pattern images.
+        """
+        filter_rows, filter_cols = filters.shape[1:]
+        height, width = dot_images.shape[1:]
+        pattern_images = np.zeros(dot_images.shape)
+
+        # Dots in the same order as a row by row scan, so overlapping stamps overwrite each other the same way
+        index, rows, cols = np.nonzero(dot_images == 1)
+
+        # The rows and columns each stamp covers: (dots, filter_rows, filter_cols)
+        start_rows = np.maximum(0, rows - filter_rows // 2)
+        start_cols = np.maximum(0, cols - filter_cols // 2)
+        stamp_index, stamp_rows, stamp_cols = np.broadcast_arrays(
+            index[:, None, None],
+            start_rows[:, None, None] + np.arange(filter_rows)[None, :, None],
+            start_cols[:, None, None] + np.arange(filter_cols)[None, None, :],
+        )
+        stamp_values = filters[index]
+
+        # Cut off the parts of stamps that hang over the bottom/right edge
+        inside = (stamp_rows < height) & (stamp_cols < width)
+        pattern_images[stamp_index[inside], stamp_rows[inside], stamp_cols[inside]] = stamp_values[inside]
+
+        return pattern_images
     
     def generate_filter(self, filter_size, old_filter = None):
-        seed = int(time()) + self.image_num
-        np.random.seed(seed)
-        self.image_num+=1
-
-        while True: #Make sure our filter is at least a little interesting
-            filter = np.random.randint(0, 2, size=(filter_size, filter_size))
-            black_pixels = np.sum(filter == 0)
-            white_pixels = np.sum(filter == 1)
-            if black_pixels >= 2 and white_pixels >= 2:
+        """
+        Generate a random binary filter with at least two black and two white pixels,
+        different from old_filter if it is given.
+        """
+        old_filters = None if old_filter is None else old_filter[None]
+        return self.generate_filters(1, filter_size, old_filters=old_filters)[0]
+
+    def generate_filters(self, n, filter_size, old_filters=None):
+        """
+        Generate n random filters at once, as an (n, filter_size, filter_size) array.
+        Uses the same rules as generate_filter: at least two black and two white pixels,
+        and different from old_filters[i] if old_filters is given.
+        Small filters are drawn straight from filter_table, larger ones by rejection sampling.
+        """
+        if filter_size <= FILTER_TABLE_MAX_SIZE:
+            masks, table = filter_table(filter_size)
+            if old_filters is None:
+                index = self.rng.integers(len(table), size=n)
+            else:
+                # Draw from every filter except old_filters[i], by skipping over its index
+                old_masks = pack_filters(old_filters)
+                old_index = np.searchsorted(masks, old_masks)
+                in_table = masks[np.minimum(old_index, len(masks) - 1)] == old_masks
+                index = self.rng.integers(len(table) - in_table, size=n)
+                index += in_table & (index >= old_index)
+            return table[index].astype(int)
+
+        filters = self.rng.integers(0, 2, size=(n, filter_size, filter_size))
+
+        while True: #Make sure our filters are at least a little interesting
+            white_pixels = filters.sum(axis=(1, 2))
+            redo = (white_pixels < 2) | (filter_size * filter_size - white_pixels < 2)
+            if old_filters is not None: #Avoid duplicate filters
+                redo |= (filters == old_filters).all(axis=(1, 2))
+            if not redo.any():
+                return filters
+            filters[redo] = self.rng.integers(0, 2, size=(redo.sum(), filter_size, filter_size))
+
+    def generate_dot_images(self, n, image_size, pixel_counts, filter_shape, old_images=None):
+        """
+        Generate n dot images at once, as an (n, image_size, image_size) array.
+        Uses the same rules as generate_dot_image, with pixel_counts[i] dots in image i,
+        and different from old_images[i] if old_images is given.
+        """
+        pixel_counts = np.broadcast_to(pixel_counts, (n,))
+        images = self._place_dots(n, image_size, pixel_counts, filter_shape)
+
+        if old_images is not None:
+            # Used if we want to avoid duplicate images
+            while True:
+                redo = np.flatnonzero((images == old_images).all(axis=(1, 2)))
+                if len(redo) == 0:
+                    break
+                images[redo] = self._place_dots(len(redo), image_size, pixel_counts[redo], filter_shape)
+
+        return images
+
+    def _place_dots(self, n, image_size, pixel_counts, filter_shape):
+        """Place the dots for generate_dot_images, one dot per image per step."""
+        buffer = max(filter_shape)
+        images = np.zeros((n, image_size, image_size))
+
+        # Pixels that are still far enough from the edges and from every dot placed so far
+        available = np.zeros((n, image_size, image_size), dtype=bool)
+        available[:, buffer:image_size - buffer, buffer:image_size - buffer] = True
+
+        row_offsets = np.arange(-filter_shape[0] + 1, filter_shape[0])
+        col_offsets = np.arange(-filter_shape[1] + 1, filter_shape[1])
+
+        for step in range(int(pixel_counts.max(initial=0))):
+            active = np.flatnonzero((pixel_counts > step) & available.any(axis=(1, 2)))
+            if len(active) == 0:
                 break
 
-        if old_filter is not None: #Avoid duplicate filter
-            if np.array_equal(old_filter, filter):
-                return self.generate_filter(filter_size, old_filter=old_filter)
-        return filter
+            # The largest random score among the available pixels is a uniform choice
+            scores = self.rng.random((len(active), image_size * image_size))
+            scores[~available[active].reshape(len(active), -1)] = -1
+            rows, cols = np.divmod(scores.argmax(axis=1), image_size)
+            images[active, rows, cols] = 1
+
+            # Pixels that are too close to the selected pixel are no longer available
+            near_rows = np.clip(rows[:, None] + row_offsets, 0, image_size - 1)
+            near_cols = np.clip(cols[:, None] + col_offsets, 0, image_size - 1)
+            available[active[:, None, None], near_rows[:, :, None], near_cols[:, None, :]] = False
+
+        return images
+
+    def generate_batch(self, n, filter_size=3, image_size=None):
+        """
+        Generate n convolution problems at once, as stacked arrays.
+        All problems in a batch share one image size, so they can be stacked.
+        Returns a dict with:
+        - 'descriptions': list of n problem descriptions
+        - 'filters': (n, k, k) array of filters
+        - 'images': (n, S, S) array of dot images
+        - 'options': (n, 4, S, S) array of convolved images. Option 0 is the right answer,
+          options 1-3 are the wrong answers in the same order as generate_wrong_answers.
+        """
+        if image_size is None:
+            image_size = int(self.rng.integers(20, 26))
+        pixel_counts = self.rng.integers(4, 9, size=n)
+
+        filters = self.generate_filters(n, filter_size)
+        images = self.generate_dot_images(n, image_size, pixel_counts, filters.shape[1:])
+        pixel_counts = images.sum(axis=(1, 2)).astype(int)
+
+        # Same three wrong answers as generate_wrong_answers
+        wrong_images_1 = self.generate_dot_images(n, image_size, pixel_counts, filters.shape[1:], old_images=images)
+        wrong_filters_2 = self.generate_filters(n, filter_size, old_filters=filters)
+        wrong_filters_3 = self.generate_filters(n, filter_size, old_filters=filters)
+        wrong_images_3 = self.generate_dot_images(n, image_size, pixel_counts, filters.shape[1:], old_images=images)
+
+        option_images = np.stack([images, wrong_images_1, images, wrong_images_3], axis=1)
+        option_filters = np.stack([filters, filters, wrong_filters_2, wrong_filters_3], axis=1)
+
+        if self.mode == 'pattern':
+            option_images = self.generate_pattern_images(option_images.reshape(-1, image_size, image_size),
+                                                         option_filters.reshape(-1, filter_size, filter_size))
+            option_images = option_images.reshape(n, 4, image_size, image_size)
+
+        # All four options of every problem in one pass
+        options = batch_convolve2d(option_images, option_filters)
+
+        description = self.describe_problem(filter_size, image_size)
+
+        return {'descriptions': [description] * n, 'filters': filters, 'images': images, 'options': options}
+
+    def batch_to_records(self, batch):
+        """
+        Pack a batch from generate_batch into fixed-size problem bank records, see problembank.
+        Values are stored in the smallest types that hold them exactly.
+        """
+        n, k = batch['filters'].shape[:2]
+        image_size = batch['images'].shape[1]
+        records = np.zeros(n, dtype=[('filter', np.uint8, (k, k)),
+                                     ('image', np.uint8, (image_size, image_size)),
+                                     ('options', np.int16, (4, image_size, image_size))])
+        records['filter'] = batch['filters']
+        records['image'] = batch['images']
+        records['options'] = batch['options']
+        return records
+
+    def records_to_batch(self, records):
+        """
+        Unpack problem bank records from batch_to_records into a batch, as generate_batch returns it.
+        """
+        k = records.dtype['filter'].shape[0]
+        image_size = records.dtype['image'].shape[0]
+        return {'descriptions': [self.describe_problem(k, image_size)] * len(records),
+                'filters': records['filter'].astype(int),
+                'images': records['image'].astype(float),
+                'options': records['options'].astype(float)}
+
+    def load_batch_item(self, batch, i):
+        """
+        Make problem i of a batch from generate_batch the current problem.
+        """
+        self.problem = [batch['descriptions'][i], (batch['filters'][i], batch['images'][i])]
+        self.right_answer = batch['options'][i, 0]
+        self.wrong_answers = list(batch['options'][i, 1:])
+        self.session.correct = 0 # Unshuffled, so the right answer comes first
+        return self.problem
+
+    def describe_problem(self, filter_size, image_size):
+        """
+        Returns the prompt for a problem with the given filter and image sizes.
+        """
+        return f"Given the following {filter_size}x{filter_size} filter, convolve it with the following {image_size}x{image_size} image:"
 
-    def generate_problem(self, filter_size=3):
+    def generate_problem(self, filter_size=3, image_size=None, pixel_count=None):
         """
         Generate a random convolution problem.
+        image_size and pixel_count (the number of dots) are random unless given.
         Returns a list containing the problem description and a tuple of the filter and image.
         Also writes it to self.problem.
         """
@@ -115,14 +707,16 @@ class ConvolutionTest(StudentTest):
         filter = self.generate_filter(filter_size)
 
         # Generate a random image size and pixel count
-        image_size = random.randint(20, 25)
-        pixel_count = random.randint(4, 8)
+        if image_size is None:
+            image_size = int(self.rng.integers(20, 26))
+        if pixel_count is None:
+            pixel_count = int(self.rng.integers(4, 9))
 
         # Generate the image with randomly placed pixels
         dot_image = self.generate_dot_image(image_size, pixel_count, filter)
 
         # Generate the problem description
-        problem_description = f"Given the following {filter.shape[0]}x{filter.shape[1]} filter, convolve it with the following {image_size}x{image_size} image:"
+        problem_description = self.describe_problem(filter.shape[0], image_size)
 
         self.problem = [problem_description, (filter, dot_image)]
 
@@ -138,7 +732,7 @@ class ConvolutionTest(StudentTest):
         if self.mode == 'pattern':
             image = self.generate_pattern_image(image, filter)
         
-        convolved_image = convolve2d(image, filter, mode='same')
+        convolved_image = batch_convolve2d(image[None], filter[None])[0]
         
         self.right_answer = convolved_image
 
@@ -175,10 +769,24 @@ class ConvolutionTest(StudentTest):
 
             wrong_problems = [ (self.generate_pattern_image(im, fil), fil) for im, fil in wrong_problems]
 
-        self.wrong_answers = [convolve2d(im, fil, mode='same') for im, fil in wrong_problems]
+        # All three in one call, see batch_convolve2d
+        images = np.stack([im for im, fil in wrong_problems])
+        filters = np.stack([fil for im, fil in wrong_problems])
+        self.wrong_answers = list(batch_convolve2d(images, filters))
 
         return self.wrong_answers
 
+    def get_renderer(self):
+        """
+        Returns the renderer for self.backend used by render_problem/render_answer, building it on first use.
+        """
+        if self.renderer is None:
+            if self.backend == 'numpy':
+                self.renderer = ConvolutionRasterRenderer()
+            else:
+                self.renderer = ConvolutionRenderer()
+        return self.renderer
+
     def render_problem(self):
         """
         Render the convolution problem as an image.
@@ -189,63 +797,20 @@ class ConvolutionTest(StudentTest):
         if self.mode == 'pattern':
             image = self.generate_pattern_image(image, filter)
 
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(6, 3))
-        cmap = plt.cm.gray
-
-        # Display the filter
-        ax1.imshow(filter, cmap=cmap, interpolation='nearest', vmin=0, vmax=1, extent= [0,1,0,1])
-        ax1.set_title('Filter')
-        ax1.axis('off')
-
-        # Add a border around the plot
-        border_width = 2  # Adjust the border width as needed
-        border_color = 'black'  # Adjust the border color as needed
-        rect = patches.Rectangle((0, 0), 1, 1, linewidth=border_width, edgecolor=border_color, facecolor='none')
-        ax1.add_patch(rect)
-
-        # Display the image
-        ax2.imshow(image, cmap=cmap, interpolation='nearest', vmin=0, vmax=1, extent= [0,1,0,1])
-        ax2.set_title('Image')
-        ax2.axis('off')
-
-        # Add a border around the plot
-        border_width = 2  # Adjust the border width as needed
-        border_color = 'black'  # Adjust the border color as needed
-        rect = patches.Rectangle((0,0), 1, 1, linewidth=border_width, edgecolor=border_color, facecolor='none')
-        ax2.add_patch(rect)
-
-        plt.tight_layout()
-        plt.savefig('convolution_problem.png')
-        plt.close()
-
-        return Image.open('convolution_problem.png')
+        return self.get_renderer().render_problem(filter, image)
 
-    
-        
     def render_answer(self, answer):
         """
         Render the answer (convolved image) as an image.
         Returns a PIL Image object representing the answer.
         """
-        fig, ax = plt.subplots(figsize=(2, 2))  # Adjust the figsize to make the image smaller
-        cmap = plt.cm.gray
+        return self.get_renderer().render_answer(answer)
 
-        # Display the convolved image
-        ax.imshow(answer, cmap=cmap, interpolation='nearest', vmin=0, vmax=np.max(answer), extent= [0,1,0,1])
-        ax.set_title('Convolved Image', fontsize=8)  # Adjust the fontsize of the title
-        ax.axis('off')
-
-        # Add a border around the plot
-        border_width = 2  # Adjust the border width as needed
-        border_color = 'black'  # Adjust the border color as needed
-        rect = patches.Rectangle((0, 0), 1, 1, linewidth=border_width, edgecolor=border_color, facecolor='none')
-        ax.add_patch(rect)
-
-        plt.tight_layout()
-        plt.savefig('convolved_image.png')
-        plt.close()
-
-        return Image.open('convolved_image.png')
+    def render_answers(self, answers):
+        """
+        Render several answers at once, see StudentTest.render_answers.
+        """
+        return self.get_renderer().render_answers(answers)
     
     def is_correct(self, answer):
         """
@@ -1,219 +1,324 @@
 import numpy as np
-import random
-import matplotlib.pyplot as plt
-plt.rcParams.update({'text.usetex': True})
-plt.rcParams['text.latex.preamble'] = r'\usepackage{amsmath}'
-from scipy.signal import convolve2d
-
-from time import time
-
-
-import tkinter as tk
-from PIL import ImageTk, Image
-import random
-import matplotlib.patches as patches
-from collections import Counter
+from PIL import Image, ImageDraw
 
 from studenttest import StudentTest
+from rasterize import load_font
+from matrixmultiplytest import MatrixMultiplyRenderer, MatrixRasterRenderer
+
+# Entries of the matrices shown to students
+ENTRY_LOW, ENTRY_HIGH = -5, 5
+
+
+# Bareiss multiplies two minors before dividing, so int64 is only safe while minors stay below 2**31
+INT64_SAFE_BOUND = 2.0 ** 31
+
+
+def hadamard_bounds(matrices):
+    """
+    Returns an upper bound on the absolute value of every minor of each matrix in an (N, n, n) stack,
+    as floats: the product of the row lengths, counting rows shorter than 1 as 1.
+    """
+    norms = np.sqrt((np.asarray(matrices, dtype=float) ** 2).sum(axis=2))
+    return np.prod(np.maximum(norms, 1), axis=1)
+
+
+def bareiss_determinants(matrices):
+    """
+    Exact determinants of a stack of integer matrices, as an (N,) int64 array for an (N, n, n) array.
+    Uses fraction-free Bareiss elimination on all matrices at once: every division is exact, so unlike
+    np.linalg.det nothing is rounded, and a singular matrix always comes out as exactly 0.
+    Matrices whose entries could overflow int64 along the way (see hadamard_bounds) are eliminated with
+    Python integers instead, which is slower but exact; their determinants are returned as an object array.
+    """
+    matrices = np.asarray(matrices)
+    N, n, _ = matrices.shape
+    if n == 0:
+        return np.ones(N, dtype=np.int64)
+
+    safe = hadamard_bounds(matrices) < INT64_SAFE_BOUND
+    if safe.all():
+        return bareiss_eliminate(np.array(matrices, dtype=np.int64))
+
+    determinants = np.empty(N, dtype=object)
+    determinants[safe] = bareiss_eliminate(np.array(matrices[safe], dtype=np.int64)).astype(object)
+    determinants[~safe] = bareiss_eliminate(np.array(matrices[~safe], dtype=object))
+    return determinants
+
+
+def bareiss_eliminate(M):
+    """
+    Bareiss elimination of an (N, n, n) int64 or object (Python int) array, in place. Returns the determinants.
+    """
+    N, n, _ = M.shape
+    rows = np.arange(N)
+    sign = np.ones(N, dtype=M.dtype)
+    singular = np.zeros(N, dtype=bool)
+    previous = np.ones(N, dtype=M.dtype)
+    for k in range(n - 1):
+        # Swap a nonzero pivot into row k where needed. If column k has none left, the matrix is singular
+        nonzero = (M[:, k:, k] != 0).astype(bool)
+        singular |= ~nonzero.any(axis=1)
+        pivot_rows = nonzero.argmax(axis=1) + k
+        swap = pivot_rows != k
+        if swap.any():
+            swapped, pivot_rows = rows[swap], pivot_rows[swap]
+            row_k = M[swapped, k].copy()
+            M[swapped, k] = M[swapped, pivot_rows]
+            M[swapped, pivot_rows] = row_k
+            sign[swap] = -sign[swap]
+
+        # Singular matrices get a dummy pivot, so they never divide by zero
+        pivot = np.where(singular, 1, M[:, k, k]).astype(M.dtype)
+        M[:, k + 1:, k + 1:] = (M[:, k + 1:, k + 1:] * pivot[:, None, None]
+                                - M[:, k + 1:, k, None] * M[:, k, None, k + 1:]) // previous[:, None, None]
+        previous = pivot
+
+    return np.where(singular, 0, sign * M[:, n - 1, n - 1]).astype(M.dtype)
+
+
+def in_range(matrices):
+    """
+    Returns which matrices of a stack have all their entries between ENTRY_LOW and ENTRY_HIGH.
+    """
+    return ((matrices >= ENTRY_LOW) & (matrices <= ENTRY_HIGH)).all(axis=(1, 2))
+
+
+def singular_matrices(rng, count, size):
+    """
+    Generate count size x size singular matrices, as a (count, size, size) int64 array.
+    Each is a random matrix with one row replaced by an integer combination of the others
+    (a multiple of one row, or a*u + b*v of two), transposed half of the time so it is a column instead.
+    Matrices with entries out of range are drawn again, and all of them are checked with bareiss_determinants.
+    """
+    matrices = np.empty((count, size, size), dtype=np.int64)
+    todo = np.arange(count)
+    while len(todo):
+        k = len(todo)
+        M = rng.integers(ENTRY_LOW, ENTRY_HIGH + 1, size=(k, size, size))
+
+        # Target row t, made from rows u and v
+        order = np.argsort(rng.random((k, size)), axis=1)
+        t, u, v = order[:, 0], order[:, 1], order[:, min(2, size - 1)]
+        a = rng.choice([-2, -1, 1, 2], size=k)
+        b = rng.integers(-1, 2, size=k) if size > 2 else np.zeros(k, dtype=np.int64)
+        which = np.arange(k)
+        M[which, t] = a[:, None] * M[which, u] + b[:, None] * M[which, v]
+
+        transpose = rng.random(k) < 0.5
+        M[transpose] = M[transpose].transpose(0, 2, 1)
+
+        ok = in_range(M)
+        ok[ok] = bareiss_determinants(M[ok]) == 0
+        matrices[todo[ok]] = M[ok]
+        todo = todo[~ok]
+    return matrices
+
+
+def unimodular_matrices(rng, count, size):
+    """
+    Generate count size x size matrices with determinant +-1: products of unit lower and upper triangular
+    matrices with entries -1..1, with their rows shuffled.
+    """
+    lower = np.tril(rng.integers(-1, 2, size=(count, size, size)), -1) + np.eye(size, dtype=np.int64)
+    upper = np.triu(rng.integers(-1, 2, size=(count, size, size)), 1) + np.eye(size, dtype=np.int64)
+    product = np.matmul(lower, upper)
+    order = np.argsort(rng.random((count, size)), axis=1)
+    return np.take_along_axis(product, order[:, :, None], axis=1)
+
+
+def nonsingular_matrices(rng, count, size):
+    """
+    Generate count size x size matrices with nonzero determinant, as a (count, size, size) int64 array.
+    They come from three constructions, picked at random for each matrix:
+    - a random matrix
+    - a singular matrix with one entry moved by 1, which looks just as dependent at a glance
+    - a unimodular product, see unimodular_matrices
+    Matrices that are singular (checked with bareiss_determinants) or out of range are drawn again.
+    """
+    matrices = np.empty((count, size, size), dtype=np.int64)
+    todo = np.arange(count)
+    while len(todo):
+        k = len(todo)
+        M = rng.integers(ENTRY_LOW, ENTRY_HIGH + 1, size=(k, size, size))
+        construction = rng.integers(0, 3, size=k)
+
+        near = np.flatnonzero(construction == 1)
+        if len(near):
+            M[near] = singular_matrices(rng, len(near), size)
+            entries = rng.integers(0, size, size=(len(near), 2))
+            M[near, entries[:, 0], entries[:, 1]] += rng.choice([-1, 1], size=len(near))
+
+        unimodular = np.flatnonzero(construction == 2)
+        if len(unimodular):
+            M[unimodular] = unimodular_matrices(rng, len(unimodular), size)
+
+        ok = in_range(M)
+        ok[ok] = bareiss_determinants(M[ok]) != 0
+        matrices[todo[ok]] = M[ok]
+        todo = todo[~ok]
+    return matrices
+
 
 class DeterminantTest(StudentTest):
-    def __init__(self, max_streak=10):
+    BANK_PARAMS = ['mode', 'size', 'typesetter']
+
+    def __init__(self, max_streak=10, mode='find_zero', size=3, typesetter='latex', seed=None):
         """
         mode:
         - find_zero: The user has to find a matrix with zero determinant
         - find_nonzero: The user has to find a matrix with nonzero determinant
+        size: the matrices are size x size, at least 2
+        typesetter given as either 'latex' or 'pil', see MatrixMultiplyTest
+        seed: optional root seed for the random stream, see StudentTest
         """
-        super().__init__(max_streak)
+        super().__init__(max_streak, seed)
 
+        if mode not in ['find_zero', 'find_nonzero']:
+            raise ValueError("Invalid mode. Choose 'find_zero' or 'find_nonzero'")
+        if size < 2:
+            raise ValueError("Invalid size. Matrices must be at least 2x2")
+        if typesetter not in ['latex', 'pil']:
+            raise ValueError("Invalid typesetter. Choose 'latex' or 'pil'")
 
+        self.mode = mode
+        self.size = size
+        self.typesetter = typesetter
+        self.problem_image = None
 
-    def generate_problem(self):
+    def right_matrices(self, count):
         """
-        The problem statement explains that we're checking for nonzero determinant.
+        Generate count matrices that are right answers for self.mode.
         """
         if self.mode == 'find_zero':
-            problem_description = "Find a matrix with zero determinant."
+            return singular_matrices(self.rng, count, self.size)
+        return nonsingular_matrices(self.rng, count, self.size)
 
+    def wrong_matrices(self, count):
+        """
+        Generate count matrices that are wrong answers for self.mode.
+        """
+        if self.mode == 'find_zero':
+            return nonsingular_matrices(self.rng, count, self.size)
+        return singular_matrices(self.rng, count, self.size)
+
+    def describe_problem(self):
+        """
+        Returns the prompt for self.mode.
+        """
+        if self.mode == 'find_zero':
+            return "Find the matrix with zero determinant:"
         if self.mode == 'find_nonzero':
-            problem_description = "Find a matrix with nonzero determinant."
+            return "Find the matrix with nonzero determinant:"
 
-        self.problem = [problem_description, None]
+    def generate_problem(self):
+        """
+        The problem statement explains which determinant we're looking for.
+        The internal representation is the size of the matrices.
+        """
+        self.problem = [self.describe_problem(), self.size]
 
         return self.problem
 
     def generate_right_answer(self):
         """
-        Generate the right answer for the matrix multiplication problem.
-        Returns the correct matrix multiplication result.
+        Generate the right answer: a matrix with zero determinant for find_zero, nonzero for find_nonzero.
         """
-        if self.mode == 'find_zero':
-            pass
-
-        if self.mode == 'find_nonzero':
-            pass
+        self.right_answer = self.right_matrices(1)[0]
 
         return self.right_answer
-    
-
-    ###########################THE REST OF THIS CODE IS THE SAME AS THE MATRIX MULTIPLY TEST######################
 
     def generate_wrong_answers(self):
         """
-        Generate wrong answers for the matrix multiplication problem.
-        Returns a list of 3 wrong answers.
-        """
-        A, B, _, _ = self.problem[1]
-        wrong_answers = []
-
-        if self.mode == 'shape_calculation':
-            # Calculate the shape of the result
-            m,p = A.shape 
-            p,n = B.shape
-
-            #Sample three elements
-            options = [(m,p,n),(n,p,m), (p,n,m), (p,m,n),(n,m,p), (p,p,m)]
-            selected_optionas = random.sample(options, 3)
-
-            for M,N,P in selected_optionas: #Generate two wrong answers
-                A,B = self.generate_matrix_pair(M,N,P)
-                wrong_answers.append(np.dot(A,B))
-            
-
-           
-
-        if self.mode == 'shape_matching':
-
-            # Generate four variations of matrix multiplication
-            variations = [
-                [A, B],
-                [A, B.T],
-                [B, A],
-                [A.T, B]
-            ]
-            transposed_variations = [
-                [B.T, A.T],
-                [B,   A.T],
-                [A.T, B.T],
-                [B.T, A]
-            ]
-
-            # Find the invalid matrix multiplications
-            
-            for i in range(len(variations)):
-                display_transposed = random.choice([True, False])
-                variation = transposed_variations[i] if display_transposed else variations[i]
-                #print(i)
-                #print(variation[0].shape, variation[1].shape)
-                if variation[0].shape[1] != variation[1].shape[0]:
-                    wrong_answers.append(variation)
-
-        self.wrong_answers = wrong_answers
+        Generate 3 wrong answers: matrices with the other kind of determinant.
+        """
+        self.wrong_answers = list(self.wrong_matrices(3))
 
         return self.wrong_answers
-    
-    def latex_matrix(self, matrix):
+
+    def generate_batch(self, n):
         """
-        Generate LaTeX code for a matrix.
+        Generate n problems at once.
+        Returns a dict with:
+        - 'descriptions': list of n prompts
+        - 'problems': list of n matrix sizes
+        - 'options': (n, 4, size, size) int64 array of the answers. Option 0 is the right answer.
         """
-        if self.visual == 'numerical':
-            matrix_latex = r'$\begin{bmatrix}'
-            for i in range(matrix.shape[0]):
-                row = ' & '.join(str(x) for x in matrix[i])
-                matrix_latex += row + r' \\ '
-            matrix_latex += r'\end{bmatrix}$'
-            return matrix_latex
-        if self.visual == 'dot':
-            matrix_latex = r'$\begin{bmatrix}'
-            for i in range(matrix.shape[0]):
-                row = ' & '.join('\cdot' for x in matrix[i])
-                matrix_latex += row + r' \\ '
-            matrix_latex += r'\end{bmatrix}$'
-        return matrix_latex
+        options = np.concatenate([self.right_matrices(n)[:, None],
+                                  self.wrong_matrices(3 * n).reshape(n, 3, self.size, self.size)], axis=1)
+        return {'descriptions': [self.describe_problem()] * n, 'problems': [self.size] * n, 'options': options}
 
-    def render_problem(self):
+    def batch_to_records(self, batch):
         """
-        Render the matrix multiplication problem as an image.
-        Returns a PIL Image object representing the problem.
+        Pack a batch from generate_batch into fixed-size problem bank records, see problembank.
         """
-        A, B, display_A_transposed, display_B_transposed = self.problem[1]
-        if display_A_transposed:
-            A = A.T
-        if display_B_transposed:
-            B = B.T
-
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(3, 3))
-
-        # Generate LaTeX code for matrix A
-        matrix_a_latex = self.latex_matrix(A)
-
-        # Generate LaTeX code for matrix B
-        matrix_b_latex = self.latex_matrix(B)
-
-        # Render LaTeX equations
-        ax1.text(0.5, 0.5, matrix_a_latex, fontsize=20, ha='center', va='center')
-        ax1.set_title(f'Matrix A ({A.shape[0]}x{A.shape[1]})')
-        ax1.axis('off')
-
-        ax2.text(0.5, 0.5, matrix_b_latex, fontsize=20, ha='center', va='center')
-        ax2.set_title(f'Matrix B ({B.shape[0]}x{B.shape[1]})')
-        ax2.axis('off')
+        records = np.zeros(len(batch['options']), dtype=[('options', np.int8, (4, self.size, self.size))])
+        records['options'] = batch['options']
+        return records
 
-        plt.tight_layout()
-        plt.savefig('matrix_multiplication_problem.png')
-        plt.close()
-        return Image.open('matrix_multiplication_problem.png')
+    def records_to_batch(self, records):
+        """
+        Unpack problem bank records from batch_to_records into a batch, as generate_batch returns it.
+        """
+        n = len(records)
+        return {'descriptions': [self.describe_problem()] * n, 'problems': [self.size] * n,
+                'options': records['options'].astype(np.int64)}
 
+    def latex_matrix(self, matrix):
+        """
+        Generate LaTeX code for a matrix.
+        """
+        rows = [' & '.join(str(x) for x in row) for row in np.asarray(matrix).tolist()]
+        return r'$\begin{bmatrix}' + r' \\ '.join(rows) + r' \\ \end{bmatrix}$'
 
+    def get_renderer(self):
+        """
+        Returns the renderer for self.typesetter used by render_answer, building it on first use.
+        """
+        if self.renderer is None:
+            if self.typesetter == 'pil':
+                self.renderer = MatrixRasterRenderer('numerical')
+            else:
+                self.renderer = MatrixMultiplyRenderer(self.latex_matrix)
+        return self.renderer
 
-    def render_answer(self, answer): #Currently not working
+    def render_problem(self):
         """
-        Render the answer (two matrices side-by-side in multiplication) as an image.
+        Render the determinant we're looking for as an image.
+        It only depends on the mode, so it is drawn once.
+        """
+        if self.problem_image is None:
+            image = Image.new('L', (300, 100), 255)
+            draw = ImageDraw.Draw(image)
+            formula = 'det(M) = 0' if self.mode == 'find_zero' else 'det(M) ≠ 0'
+            draw.text((150, 50), formula, fill=0, font=load_font(28), anchor='mm')
+            self.problem_image = image
+        return self.problem_image
+
+    def render_answer(self, answer):
+        """
+        Render the answer (a matrix) as an image.
         Returns a PIL Image object representing the answer.
         """
-        
-        fig, ax = plt.subplots(figsize=(3,3))
-        ax.axis('off')
-        
-        if self.mode == 'shape_matching':
-            A, B = answer
-            # Generate LaTeX code for matrix A
-            matrix_a_latex = self.latex_matrix(A)[:-1]
-            
-            # Generate LaTeX code for matrix B
-            matrix_b_latex = self.latex_matrix(B)[1:]
-        
-        if self.mode == 'shape_calculation': # Use \cdot to indicate each number
-            C = answer
-            # Generate LaTeX code for matrix C
-            matrix_a_latex = self.latex_matrix(C)
-            matrix_b_latex = ''
-
-
-        # Render LaTeX equations
-        ax.text(0, 0.5, matrix_a_latex+matrix_b_latex, fontsize=20, va='center')
-        #ax.text(offset, 0.5, matrix_b_latex, fontsize=20, va='center')
-        
-        plt.tight_layout()
-        plt.savefig('matrix_multiplication_answer.png')
-        plt.close()
-        
-        return Image.open('matrix_multiplication_answer.png')
-    
-    
+        return self.get_renderer().render_answer([answer])
+
+    def render_answers(self, answers):
+        """
+        Render several answers at once, see StudentTest.render_answers.
+        """
+        return self.get_renderer().render_answers([[answer] for answer in answers])
+
     def is_correct(self, answer):
         """
-        Check if the given answer is correct.
+        Check if the given answer is correct, from its exact determinant.
         Returns True if the answer is correct, False otherwise.
         """
-        if self.mode == 'shape_matching':
-            Aright, Bright = self.right_answer
-            A, B = answer
-            return np.array_equal(Aright, A) and np.array_equal(Bright, B)
-        if self.mode == 'shape_calculation':
-            return np.array_equal(self.right_answer, answer)
-    
-# Create an instance of the ConvolutionTest class
-test = MatrixMultiplicationTest(max_streak=3, mode='shape_calculation', visual = 'numerical')
-
-# Call the display_test() method to run the test
-test.display_test()
\ No newline at end of file
+        singular = bareiss_determinants(np.asarray(answer)[None])[0] == 0
+        return singular == (self.mode == 'find_zero')
+
+
+if __name__ == '__main__':
+    # Create an instance of the DeterminantTest class
+    test = DeterminantTest(max_streak=3, mode='find_zero')
+
+    # Call the display_test() method to run the test
+    test.display_test()
@@ -0,0 +1,190 @@
+"""
+Export a whole quiz as a static worksheet (HTML or PDF), plus a separate answer key.
+Questions are generated and rendered across a process pool.
+"""
+import base64
+import html
+import itertools
+import os
+import textwrap
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw
+
+from instrumentation import MetricsRegistry
+from problembank import encode_png
+from rasterize import load_font
+
+OPTION_LABELS = 'ABCDEFGHIJKLMNOP'
+
+
+def export_chunk(test, n, record_metrics=False):
+    """
+    Prepare n questions with test (run in a worker process).
+    Returns them as dicts with the prompt, the PNG bytes of every image and the position of the right answer,
+    and the stage timings as a list of (test name, stage, seconds) if record_metrics, else an empty list.
+    """
+    observations = []
+    if record_metrics:
+        test.metrics = MetricsRegistry()
+        test.metrics.add_listener(lambda *observation: observations.append(observation))
+
+    questions = []
+    for _ in range(n):
+        question = test.prepare_question()
+        questions.append({
+            'prompt': question['problem'][0],
+            'problem_image': encode_png(question['problem_image']),
+            'answer_images': [encode_png(image) for image in question['answer_images']],
+            'correct': question['correct'],
+        })
+    return questions, observations
+
+
+def generate_questions(test, count, workers=None, chunk_size=50):
+    """
+    Prepare count questions in a process pool, in chunks of chunk_size.
+    Every chunk gets its own clone of test with its own random stream, see StudentTest.spawn.
+    A metrics registry can't be sent to another process, so the workers time into their own,
+    and the timings are added to test.metrics afterwards. A bank goes as its path, see ProblemBank.
+    """
+    sizes = [min(chunk_size, count - start) for start in range(0, count, chunk_size)]
+    clones = test.spawn(len(sizes))
+    for clone in clones:
+        clone.metrics = None
+
+    questions = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk, observations in executor.map(export_chunk, clones, sizes, [test.metrics is not None] * len(sizes)):
+            questions.extend(chunk)
+            for observation in observations:
+                test.metrics.observe(*observation)
+    return questions
+
+
+def data_uri(png):
+    """
+    Returns PNG bytes as a data: URI, to inline images in HTML.
+    """
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+
+
+def write_html(questions, path, title):
+    """
+    Write the questions as one self-contained HTML file, with every image inlined.
+    """
+    parts = [f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>',
+             '<style>body{font-family:sans-serif} .question{page-break-inside:avoid;margin-bottom:2em} '
+             '.options{display:flex;flex-wrap:wrap;gap:1em} figure{margin:0;text-align:center}</style>',
+             f'</head><body><h1>{html.escape(title)}</h1>']
+    for number, question in enumerate(questions, 1):
+        parts.append(f'<div class="question"><h3>{number}. {html.escape(question["prompt"])}</h3>')
+        parts.append(f'<img src="{data_uri(question["problem_image"])}">')
+        parts.append('<div class="options">')
+        for label, image in zip(OPTION_LABELS, question['answer_images']):
+            parts.append(f'<figure><img src="{data_uri(image)}"><figcaption>{label}</figcaption></figure>')
+        parts.append('</div></div>')
+    parts.append('</body></html>\n')
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(parts))
+
+
+def write_html_answer_key(questions, path, title):
+    """
+    Write the answer key (question number and letter of the right answer) as an HTML file.
+    """
+    rows = ''.join(f'<tr><td>{number}</td><td>{OPTION_LABELS[question["correct"]]}</td></tr>'
+                   for number, question in enumerate(questions, 1))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)} - answer key</title>'
+                f'</head><body><h1>{html.escape(title)} - answer key</h1>'
+                f'<table><tr><th>Question</th><th>Answer</th></tr>{rows}</table></body></html>\n')
+
+
+def question_page(number, question, font, size=(1240, 1754)):
+    """
+    Lay out one question on an A4 page at 150 dpi: prompt, problem image, then the options in a grid.
+    """
+    page = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(page)
+    margin = 80
+
+    prompt = '\n'.join(textwrap.wrap(f'{number}. {question["prompt"]}', 70))
+    draw.multiline_text((margin, margin), prompt, fill='black', font=font)
+
+    problem_top = margin + 40 * (prompt.count('\n') + 1) + 20
+    problem = Image.open(BytesIO(question['problem_image'])).convert('RGB')
+    page.paste(problem, ((size[0] - problem.width) // 2, problem_top))
+
+    top = problem_top + problem.height + 40
+    columns = 2
+    cell_width = (size[0] - 2 * margin) // columns
+    for i, (label, png) in enumerate(zip(OPTION_LABELS, question['answer_images'])):
+        image = Image.open(BytesIO(png)).convert('RGB')
+        row, column = divmod(i, columns)
+        left = margin + column * cell_width + (cell_width - image.width) // 2
+        cell_top = top + row * (image.height + 60)
+        draw.text((left, cell_top), f'{label})', fill='black', font=font)
+        page.paste(image, (left, cell_top + 30))
+
+    return page
+
+
+def answer_key_pages(questions, font, size=(1240, 1754), per_page=50):
+    """
+    Lay out the answer key as text pages. Yields the pages one at a time.
+    """
+    for start in range(0, len(questions), per_page):
+        page = Image.new('RGB', size, 'white')
+        draw = ImageDraw.Draw(page)
+        draw.text((80, 80), 'Answer key', fill='black', font=font)
+        for row, question in enumerate(questions[start:start + per_page]):
+            draw.text((80, 140 + 30 * row), f'{start + row + 1}. {OPTION_LABELS[question["correct"]]}',
+                      fill='black', font=font)
+        yield page
+
+
+def write_pdf(pages, path, batch_size=20):
+    """
+    Write page images (any iterable, such as a generator) as one PDF.
+    Pages are appended to the file batch_size at a time, so only one batch is ever held in memory.
+    """
+    pages = iter(pages)
+    append = False
+    while True:
+        batch = list(itertools.islice(pages, batch_size))
+        if not batch:
+            break
+        batch[0].save(path, save_all=True, append=append, append_images=batch[1:], resolution=150)
+        append = True
+    if not append:
+        raise ValueError("A PDF needs at least one page")
+
+
+def export_quiz(test, count, path, answer_key_path=None, title='Student Test', workers=None, chunk_size=50):
+    """
+    Generate and render count questions of test across a process pool, and write them as a worksheet.
+    The format follows the extension of path: .pdf for PDF, anything else for a self-contained HTML file.
+    The answer key goes to answer_key_path, by default path with '-answers' added before the extension.
+    Returns the prepared questions.
+    """
+    if count < 1:
+        raise ValueError("Export at least one question")
+
+    base, extension = os.path.splitext(path)
+    if answer_key_path is None:
+        answer_key_path = base + '-answers' + extension
+
+    questions = generate_questions(test, count, workers=workers, chunk_size=chunk_size)
+
+    if extension.lower() == '.pdf':
+        font = load_font(24)
+        write_pdf((question_page(number, question, font) for number, question in enumerate(questions, 1)), path)
+        write_pdf(answer_key_pages(questions, font), answer_key_path)
+    else:
+        write_html(questions, path, title)
+        write_html_answer_key(questions, answer_key_path, title)
+
+    return questions
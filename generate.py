@@ -0,0 +1,195 @@
+"""
+Fill a problem bank (see problembank) from the command line, generating its shards across a process pool.
+
+    python -m studenttest generate --type convolution --mode pattern -n 200000 --workers 16 --out bank/
+    python -m studenttest generate --type determinant --mode find_zero -n 50000 --param size=4 --out det/
+    python -m studenttest generate --type matrix --mode shape_matching -n 1000 --render --param typesetter=pil --out m/
+
+Every shard gets its own random stream, split off the root seed by shard number, so a bank's contents only
+depend on the seed and the shard size, not on the number of workers or the order shards finish in.
+Shards are written as soon as they are done. Running the same command again resumes an interrupted run:
+shards already on disk are kept, and only the missing ones are generated. A larger -n extends the bank,
+a smaller one never removes questions.
+"""
+import argparse
+import ast
+import importlib
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from problembank import check_info, read_info, shard_path, write_info, write_shard
+
+# --type -> (module, class). Modules are only imported when used
+TEST_TYPES = {
+    'convolution': ('convolutiontest', 'ConvolutionTest'),
+    'matrix': ('matrixmultiplytest', 'MatrixMultiplyTest'),
+    'determinant': ('determinanttest', 'DeterminantTest'),
+}
+
+# Settings stored in bank.json that have to match for a run to resume a bank
+RESUME_KEYS = ['type', 'mode', 'params', 'seed', 'shard_size', 'render']
+
+
+def make_test(test_type, mode, params=None, seed=None):
+    """
+    Returns a test of type test_type (a key of TEST_TYPES) in mode, with extra constructor params.
+    """
+    module, name = TEST_TYPES[test_type]
+    test_class = getattr(importlib.import_module(module), name)
+    return test_class(mode=mode, seed=seed, **(params or {}))
+
+
+def shard_seed(seed, shard):
+    """
+    Returns the random stream of a shard: child number shard of the root seed, as SeedSequence.spawn makes them.
+    """
+    return np.random.SeedSequence(seed, spawn_key=(shard,))
+
+
+def shard_sizes(n, shard_size):
+    """
+    Returns the number of questions in every shard of a bank of n questions.
+    """
+    return [min(shard_size, n - start) for start in range(0, n, shard_size)]
+
+
+def shard_done(path, shard, size):
+    """
+    Returns True if shard is already written with at least size questions. Records are written last,
+    so they mark a finished shard. Only a short last shard of a bank that grows is written again.
+    """
+    records_path = shard_path(path, shard) + '.records.npy'
+    if not os.path.exists(records_path):
+        return False
+    return len(np.load(records_path, mmap_mode='r')) >= size
+
+
+def generate_shard(settings, path, shard, size):
+    """
+    Generate and write one shard (run in a worker process).
+    Returns (shard, size, seconds).
+    """
+    start = time.perf_counter()
+    test = make_test(settings['type'], settings['mode'], settings['params'], shard_seed(settings['seed'], shard))
+    write_shard(test, path, shard, size, render=settings['render'])
+    return shard, size, time.perf_counter() - start
+
+
+def parse_params(items):
+    """
+    Turns ['key=value', ...] into a dict. Values are read as Python literals where possible, else kept as strings.
+    """
+    params = {}
+    for item in items:
+        key, separator, value = item.partition('=')
+        if not separator:
+            raise ValueError(f"Invalid param {item!r}, expected key=value")
+        try:
+            params[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            params[key] = value
+    return params
+
+
+def generate(test_type, mode, n, path, workers=None, shard_size=10000, seed=None, params=None, render=False,
+             verbose=True):
+    """
+    Generate a bank of n questions at path, or resume/extend the one already there.
+    An existing bank keeps all of its questions, even when n is smaller than before.
+    Returns the number of questions generated by this run.
+    """
+    settings = {'type': test_type, 'mode': mode, 'params': params or {}, 'seed': seed,
+                'shard_size': shard_size, 'render': render}
+
+    # Picks up the settings of an earlier run, and refuses to mix questions made differently
+    info = read_info(path)
+    if info is not None:
+        previous = info.get('generate')
+        if previous is None:
+            raise ValueError(f"{path} holds a bank that was not written by generate, can't resume it")
+        if settings['seed'] is None:
+            settings['seed'] = previous['seed']
+        mismatched = [key for key in RESUME_KEYS if previous[key] != settings[key]]
+        if mismatched:
+            raise ValueError(f"{path} holds a bank generated with different {', '.join(mismatched)}: "
+                             + ', '.join(f'{key}={previous[key]!r}' for key in mismatched))
+    if settings['seed'] is None:
+        settings['seed'] = np.random.SeedSequence().entropy
+
+    # A bank never shrinks: a smaller -n than before keeps every question already written
+    if info is not None:
+        n = max(n, info['generate']['n'])
+
+    # Build a test here first, so bad settings fail before any worker starts.
+    # Its bank params (defaults included) have to match the ones the bank was made with
+    test = make_test(test_type, mode, settings['params'])
+    if info is not None:
+        check_info(info, test)
+    os.makedirs(path, exist_ok=True)
+    write_info(test, path, generate={**settings, 'n': n})
+
+    sizes = shard_sizes(n, shard_size)
+    pending = [(shard, size) for shard, size in enumerate(sizes) if not shard_done(path, shard, size)]
+    total = sum(size for _, size in pending)
+    if verbose:
+        print(f'{len(sizes) - len(pending)} of {len(sizes)} shards already written, '
+              f'generating {total} questions in {len(pending)} shards', flush=True)
+
+    start = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(generate_shard, settings, path, shard, size) for shard, size in pending]
+        try:
+            for finished, future in enumerate(as_completed(futures), 1):
+                shard, size, seconds = future.result()
+                done += size
+                if verbose:
+                    elapsed = time.perf_counter() - start
+                    rate = done / elapsed
+                    print(f'shard {shard} ({size} in {seconds:.1f} s), {finished}/{len(pending)} shards, '
+                          f'{done}/{total} questions, {rate:.0f} questions/s, '
+                          f'{(total - done) / rate:.0f} s left', flush=True)
+        except KeyboardInterrupt:
+            # Shards already written stay, run the same command again to resume
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m studenttest', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help='generate a problem bank')
+    generate_parser.add_argument('--type', required=True, choices=sorted(TEST_TYPES))
+    generate_parser.add_argument('--mode', required=True)
+    generate_parser.add_argument('-n', type=int, required=True, help='number of questions in the bank')
+    generate_parser.add_argument('--out', required=True, help='directory of the bank')
+    generate_parser.add_argument('--workers', type=int, help='worker processes, by default one per CPU')
+    generate_parser.add_argument('--shard-size', type=int, default=10000, help='questions per shard')
+    generate_parser.add_argument('--seed', type=int, help='root seed, by default a random one (kept for resuming)')
+    generate_parser.add_argument('--param', action='append', default=[], metavar='KEY=VALUE',
+                                 help='extra test constructor argument, for example typesetter=pil or size=4')
+    generate_parser.add_argument('--render', action='store_true', help='also render and store the images')
+    generate_parser.add_argument('--quiet', action='store_true', help="don't print progress")
+    args = parser.parse_args(argv)
+
+    try:
+        generate(args.type, args.mode, args.n, args.out, workers=args.workers, shard_size=args.shard_size,
+                 seed=args.seed, params=parse_params(args.param), render=args.render, verbose=not args.quiet)
+    except ValueError as error:
+        parser.error(str(error))
+    except KeyboardInterrupt:
+        print('Interrupted, run the same command again to resume', file=sys.stderr)
+        return 130
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
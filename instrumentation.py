@@ -0,0 +1,167 @@
+"""
+Optional timing of every stage of a question, to find out where slow questions come from.
+
+    registry = MetricsRegistry()
+    registry.instrument(test)      # or test.metrics = registry
+    test.display_test()
+    registry.write_prometheus('metrics.prom')   # or registry.write_csv('metrics.csv')
+
+Stages recorded by StudentTest: generate_problem, generate_right_answer, generate_wrong_answers,
+render_problem, render_answers (all answers of a question), load_from_bank, and in display_test photo_image
+(PIL to ImageTk conversion, once per image) and ui_update (showing a question in the window).
+
+With test.metrics left as None, every hook is a single check that hands back a shared do-nothing timer.
+"""
+import threading
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+
+
+class _NullTimer:
+    """
+    Context manager that does nothing, used when instrumentation is off.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class StageTimer:
+    """
+    Context manager that records its wall time as one observation of a stage.
+    """
+    __slots__ = ('registry', 'test', 'stage', 'start')
+
+    def __init__(self, registry, test, stage):
+        self.registry = registry
+        self.test = test
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.test, self.stage, perf_counter() - self.start)
+        return False
+
+
+def timer(registry, test, stage):
+    """
+    Returns a context manager timing stage of test (a name) into registry, or a do-nothing one if registry is None.
+    """
+    if registry is None:
+        return NULL_TIMER
+    return StageTimer(registry, test, stage)
+
+
+class RollingHistogram:
+    """
+    Durations of one stage: a count and sum over all time, and the last window observations for percentiles.
+    """
+    def __init__(self, window=1000):
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def percentiles(self, qs):
+        """
+        Returns the given percentiles (0-100) of the recent observations, in seconds.
+        """
+        if not self.recent:
+            return [float('nan')] * len(qs)
+        return np.percentile(np.fromiter(self.recent, float), qs).tolist()
+
+
+class MetricsRegistry:
+    """
+    Collects stage timings from any number of tests and threads.
+    window: number of recent observations per stage kept for percentiles.
+    """
+    QUANTILES = [0.5, 0.9, 0.99]
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.histograms = {}  # (test name, stage) -> RollingHistogram
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def instrument(self, test):
+        """
+        Record the stages of test (and of clones made from it afterwards) in this registry. Returns test.
+        """
+        test.metrics = self
+        return test
+
+    def add_listener(self, listener):
+        """
+        Call listener(test name, stage, seconds) on every observation, for example to forward it elsewhere.
+        Listeners run in the thread that made the observation.
+        """
+        self.listeners.append(listener)
+
+    def observe(self, test, stage, seconds):
+        key = (test, stage)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = RollingHistogram(self.window)
+            histogram.observe(seconds)
+        for listener in self.listeners:
+            listener(test, stage, seconds)
+
+    def snapshot(self):
+        """
+        Returns a list of dicts (test, stage, count, sum and recent percentiles in seconds), one per stage seen.
+        """
+        with self.lock:
+            items = sorted(self.histograms.items())
+            rows = []
+            for (test, stage), histogram in items:
+                p50, p90, p99 = histogram.percentiles([100 * q for q in self.QUANTILES])
+                rows.append({'test': test, 'stage': stage, 'count': histogram.count, 'sum': histogram.sum,
+                             'p50': p50, 'p90': p90, 'p99': p99,
+                             'max': max(histogram.recent) if histogram.recent else float('nan')})
+        return rows
+
+    def to_prometheus(self, name='studenttest_stage_seconds'):
+        """
+        Returns the metrics in the Prometheus text format, as a summary with the recent quantiles.
+        """
+        lines = [f'# HELP {name} Wall time of each stage of a question.', f'# TYPE {name} summary']
+        for row in self.snapshot():
+            labels = f'test="{row["test"]}",stage="{row["stage"]}"'
+            for q, key in zip(self.QUANTILES, ['p50', 'p90', 'p99']):
+                lines.append(f'{name}{{{labels},quantile="{q}"}} {row[key]:.9g}')
+            lines.append(f'{name}_sum{{{labels}}} {row["sum"]:.9g}')
+            lines.append(f'{name}_count{{{labels}}} {row["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus())
+
+    def write_csv(self, path):
+        """
+        Write one row per stage: count, total seconds, and the recent percentiles and maximum in milliseconds.
+        """
+        with open(path, 'w') as f:
+            f.write('test,stage,count,sum_seconds,p50_ms,p90_ms,p99_ms,max_ms\n')
+            for row in self.snapshot():
+                f.write(f'{row["test"]},{row["stage"]},{row["count"]},{row["sum"]:.6f},'
+                        f'{1000 * row["p50"]:.4f},{1000 * row["p90"]:.4f},{1000 * row["p99"]:.4f},'
+                        f'{1000 * row["max"]:.4f}\n')
@@ -1,23 +1,349 @@
+import threading
+from contextlib import contextmanager
+
 import numpy as np
-import random
-import matplotlib.pyplot as plt
-plt.rcParams.update({'text.usetex': True})
-plt.rcParams['text.latex.preamble'] = r'\usepackage{amsmath}'
-from scipy.signal import convolve2d
+from PIL import Image, ImageDraw
 
-from time import time
+# matplotlib takes about a second to import, so it is only loaded once a LaTeX renderer is built
+from studenttest import StudentTest
+from rasterize import load_font, format_matrix, bracket_matrix_layout, draw_bracket_matrix, atlas_tiles
+
+# matplotlib settings for the LaTeX renderer. They only apply while it draws its figures, instead of
+# changing them for every figure in the program. LaTeX itself is switched on per Text (usetex=True)
+LATEX_RC = {'text.latex.preamble': r'\usepackage{amsmath}'}
+
+# rcParams are global, so only one thread at a time may have LATEX_RC applied, see latex_context
+_latex_lock = threading.RLock()
+
+
+@contextmanager
+def latex_context():
+    """
+    Context manager that applies LATEX_RC, holding _latex_lock.
+    rc_context saves and restores the global rcParams, so renderers in different threads
+    (a prefetcher, web server workers) take turns instead of undoing each other's settings.
+    """
+    from matplotlib import rc_context
+    with _latex_lock, rc_context(LATEX_RC):
+        yield
+
+_shape_table = None
+
+# The four ways of multiplying A and B used by shape_matching, and their transposed forms.
+# Each side is (matrix, whether it is transposed)
+VARIATIONS = [
+    [('A', False), ('B', False)],
+    [('A', False), ('B', True)],
+    [('B', False), ('A', False)],
+    [('A', True),  ('B', False)],
+]
+TRANSPOSED_VARIATIONS = [
+    [('B', True),  ('A', True)],
+    [('B', False), ('A', True)],
+    [('A', True),  ('B', True)],
+    [('B', True),  ('A', False)],
+]
+
+
+def matrix_variation(A, B, index, transposed):
+    """
+    Returns one of the four ways of multiplying A and B used by shape_matching, as [left, right].
+    Variation 0 is the valid one, its transposed form is [B.T, A.T].
+    """
+    matrices = {'A': A, 'B': B}
+    variation = TRANSPOSED_VARIATIONS[index] if transposed else VARIATIONS[index]
+    return [matrices[name].T if is_transposed else matrices[name] for name, is_transposed in variation]
+
+
+def lazy_matrix_pair(seed, m, n, p):
+    """
+    Returns LazyMatrix objects A (m x p) and B (p x n), with digits made from seed (an int).
+    """
+    return LazyMatrix((m, p), (seed, 0)), LazyMatrix((p, n), (seed, 1))
+
+
+def distractor_dims(m, n, p):
+    """
+    Returns the (M, N, P) of the candidate wrong answers for shape_calculation, M x N products of an
+    M x P and a P x N matrix. None of them is m x n, the shape of the right answer.
+    """
+    return [(m, p, n), (n, p, m), (p, n, m), (p, m, n), (n, m, p), (p, p, m)]
+
+
+def shape_table():
+    """
+    Returns the table of every problem shape, built on first use. Problems use three distinct dimensions
+    m, n, p from 1-5 (A is m x p, B is p x n), so there are only 60 of them. The table is a dict with
+    - 'dims': (60, 3) array of m, n, p
+    - 'index': dict of (m, n, p) -> row
+    - 'right_index': (60,) array, the matrix_variation that is valid however it is displayed
+    - 'wrong_indices': (60, 3) array, the matrix_variations that are never valid
+    - 'distractor_dims': (60, 6, 3) array of the wrong shape_calculation answers, see distractor_dims
+    """
+    global _shape_table
+    if _shape_table is None:
+        dims = np.array([(m, n, p) for m in range(1, 6) for n in range(1, 6) for p in range(1, 6)
+                         if len({m, n, p}) == 3])
+
+        # Which variations are valid multiplications, from the shapes alone
+        valid = np.zeros((len(dims), 4, 2), dtype=bool)
+        for row, (m, n, p) in enumerate(dims.tolist()):
+            A, B = np.empty((m, p)), np.empty((p, n))
+            for index in range(4):
+                for transposed in range(2):
+                    left, right = matrix_variation(A, B, index, transposed)
+                    valid[row, index, transposed] = left.shape[1] == right.shape[0]
+
+        # Every shape needs one variation that is always valid and three that never are
+        always_valid = valid.all(axis=2)
+        if not (always_valid.sum(axis=1) == 1).all() or not ((~valid).all(axis=2).sum(axis=1) == 3).all():
+            raise ValueError("Some problem shapes have no consistent right and wrong multiplications")
+
+        _shape_table = {
+            'dims': dims,
+            'index': {(m, n, p): row for row, (m, n, p) in enumerate(dims.tolist())},
+            'right_index': always_valid.argmax(axis=1),
+            'wrong_indices': np.argsort(always_valid, axis=1, kind='stable')[:, :3],
+            'distractor_dims': np.array([distractor_dims(m, n, p) for m, n, p in dims.tolist()]),
+        }
+    return _shape_table
+
+class MatrixMultiplyRenderer:
+    """
+    Draws the images for MatrixMultiplyTest with matplotlib and LaTeX.
+    The figures and axes are built once, rendering a new question only
+    swaps the text in and redraws it on top of a cached background.
+    """
+    def __init__(self, latex_matrix):
+        """latex_matrix turns a matrix into a LaTeX string, see MatrixMultiplyTest.latex_matrix"""
+        with self.latex():
+            self.build(latex_matrix)
+
+    def latex(self):
+        """
+        Returns a context manager with the LaTeX preamble set in matplotlib, see latex_context.
+        The preamble is read when the Texts are drawn.
+        """
+        return latex_context()
 
+    def build(self, latex_matrix):
+        from matplotlib.figure import Figure
+        from rendering import FigureBlitter
 
-import tkinter as tk
-from PIL import ImageTk, Image
-import random
-import matplotlib.patches as patches
-from collections import Counter
+        self.latex_matrix = latex_matrix
+
+        # Problem: matrices A and B side by side, with their shapes as titles
+        self.problem_fig = Figure(figsize=(3, 3))
+        ax1, ax2 = self.problem_fig.subplots(1, 2)
+        self.matrix_a_text = ax1.text(0.5, 0.5, '', fontsize=20, ha='center', va='center', usetex=True)
+        self.matrix_a_title = ax1.set_title('Matrix A', usetex=True)
+        ax1.axis('off')
+        self.matrix_b_text = ax2.text(0.5, 0.5, '', fontsize=20, ha='center', va='center', usetex=True)
+        self.matrix_b_title = ax2.set_title('Matrix B', usetex=True)
+        ax2.axis('off')
+        self.problem_fig.tight_layout()
+        self.problem_blitter = FigureBlitter(self.problem_fig, [self.matrix_a_title, self.matrix_a_text,
+                                                                self.matrix_b_title, self.matrix_b_text])
+
+        # Answer: a single LaTeX expression
+        self.answer_fig = Figure(figsize=(3, 3))
+        ax = self.answer_fig.subplots()
+        ax.axis('off')
+        self.answer_text = ax.text(0, 0.5, '', fontsize=20, va='center', usetex=True)
+        self.answer_fig.tight_layout()
+        self.answer_blitter = FigureBlitter(self.answer_fig, [self.answer_text])
+        self.answer_atlases = {}  # Number of answers -> (Texts, FigureBlitter), see answer_atlas
+
+    def render_problem(self, A, B):
+        """
+        Returns a PIL Image of matrices A and B side by side, with their shapes as titles.
+        """
+        self.matrix_a_text.set_text(self.latex_matrix(A))
+        self.matrix_a_title.set_text(f'Matrix A ({A.shape[0]}x{A.shape[1]})')
+        self.matrix_b_text.set_text(self.latex_matrix(B))
+        self.matrix_b_title.set_text(f'Matrix B ({B.shape[0]}x{B.shape[1]})')
+        with self.latex():
+            return self.problem_blitter.render()
+
+    def answer_latex(self, matrices):
+        """
+        Returns a list of matrices written next to each other, as one LaTeX expression.
+        """
+        # Strip the $ signs of each matrix, so they all end up in one equation
+        return '$' + ''.join(self.latex_matrix(matrix)[1:-1] for matrix in matrices) + '$'
+
+    def render_answer(self, matrices):
+        """
+        Returns a PIL Image of a list of matrices written next to each other, in one LaTeX expression.
+        """
+        self.answer_text.set_text(self.answer_latex(matrices))
+        with self.latex():
+            return self.answer_blitter.render()
+
+    def answer_atlas(self, count):
+        """
+        Returns the Texts and FigureBlitter of a figure with count answer layouts stacked top to bottom,
+        building it on first use. Every tile has exactly the layout of the single answer figure.
+        """
+        if count not in self.answer_atlases:
+            from matplotlib.figure import Figure
+            from rendering import FigureBlitter
+
+            x0, y0, width, height = self.answer_fig.axes[0].get_position().bounds
+            with self.latex():
+                fig = Figure(figsize=(3, 3 * count))
+                texts = []
+                for i in range(count):
+                    ax = fig.add_axes([x0, (count - 1 - i + y0) / count, width, height / count])
+                    ax.axis('off')
+                    texts.append(ax.text(0, 0.5, '', fontsize=20, va='center', usetex=True))
+            self.answer_atlases[count] = (texts, FigureBlitter(fig, texts))
+        return self.answer_atlases[count]
+
+    def render_answers(self, matrices_list):
+        """
+        Returns PIL Images of several lists of matrices, the same as render_answer on each of them.
+        They are all drawn in one figure, and the Images are views of one copy of its pixels.
+        """
+        texts, blitter = self.answer_atlas(len(matrices_list))
+        for text, matrices in zip(texts, matrices_list):
+            text.set_text(self.answer_latex(matrices))
+        with self.latex():
+            return atlas_tiles(blitter.render_array(), len(matrices_list))
+
+
+class MatrixRasterRenderer:
+    """
+    Draws the same images as MatrixMultiplyRenderer with PIL, typesetting the matrices itself.
+    No LaTeX run or matplotlib is needed. Images are grayscale ('L' mode).
+    """
+    # Entries start at the size of the 20pt LaTeX matrices and shrink until the matrices fit
+    font_sizes = range(28, 9, -2)
+
+    def __init__(self, visual):
+        self.visual = visual
+        self.title_font = load_font(17)
+        self.fonts = {size: load_font(size) for size in self.font_sizes}
+
+    def fitting_font(self, entries_list, max_width, max_height, spacing=0):
+        """
+        Returns the largest font that fits all matrices in entries_list side by side in max_width x max_height.
+        """
+        for size in self.font_sizes:
+            font = self.fonts[size]
+            layouts = [bracket_matrix_layout(entries, font) for entries in entries_list]
+            width = sum(layout[0] for layout in layouts) + spacing * (len(layouts) - 1)
+            height = max(layout[1] for layout in layouts)
+            if width <= max_width and height <= max_height:
+                return font
+        return font
+
+    def render_problem(self, A, B):
+        """
+        Returns a PIL Image of matrices A and B side by side, with their shapes as titles.
+        """
+        image = Image.new('L', (300, 300), 255)
+        draw = ImageDraw.Draw(image)
+
+        for center_x, name, matrix in [(75, 'A', A), (225, 'B', B)]:
+            draw.text((center_x, 20), f'Matrix {name} ({matrix.shape[0]}x{matrix.shape[1]})', fill=0,
+                      font=self.title_font, anchor='ms')
+
+            entries = format_matrix(matrix, self.visual)
+            font = self.fitting_font([entries], 140, 250)
+            width, height, _ = bracket_matrix_layout(entries, font)
+            draw_bracket_matrix(draw, entries, font, center_x - width // 2, 160 - height // 2)
+
+        return image
+
+    def render_answer(self, matrices):
+        """
+        Returns a PIL Image of a list of matrices written next to each other.
+        """
+        image = Image.new('L', (300, 300), 255)
+        self.draw_answer(ImageDraw.Draw(image), matrices, 0)
+        return image
+
+    def render_answers(self, matrices_list):
+        """
+        Returns PIL Images of several lists of matrices, the same as render_answer on each of them.
+        They are all drawn into one canvas, and the Images are views of it.
+        """
+        image = Image.new('L', (300, 300 * len(matrices_list)), 255)
+        draw = ImageDraw.Draw(image)
+        for i, matrices in enumerate(matrices_list):
+            self.draw_answer(draw, matrices, 300 * i)
+        return atlas_tiles(np.asarray(image), len(matrices_list))
+
+    def draw_answer(self, draw, matrices, top):
+        """
+        Draw a list of matrices next to each other, in the 300x300 tile starting top pixels down.
+        """
+        entries_list = [format_matrix(matrix, self.visual) for matrix in matrices]
+        font = self.fitting_font(entries_list, 280, 280, spacing=4)
+
+        left = 10
+        for entries in entries_list:
+            width, height, _ = bracket_matrix_layout(entries, font)
+            left += draw_bracket_matrix(draw, entries, font, left, top + 150 - height // 2) + 4
+
+
+class LazyMatrix:
+    """
+    A matrix of random digits 0-8, or the product of two matrices, that is only a shape until its values are needed.
+    The shape modes only look at shapes, so generating a question allocates and multiplies nothing:
+    the values are made (once) when the matrix is shown with visual='numerical'.
+    shape, T and indexing work like an array, np.asarray(matrix) gives the values.
+    """
+    __slots__ = ('shape', 'seed', 'factors', 'transposed', '_values')
+
+    def __init__(self, shape, seed=None, factors=None, transposed=False):
+        """
+        seed: seed of the digits for np.random.default_rng (an int or a sequence of ints)
+        factors: (A, B) to be the product A @ B instead of digits
+        """
+        self.shape = tuple(shape)
+        self.seed = seed
+        self.factors = factors
+        self.transposed = transposed
+        self._values = None
+
+    @property
+    def T(self):
+        return LazyMatrix(self.shape[::-1], self.seed, self.factors, not self.transposed)
+
+    def values(self):
+        """
+        Returns the values as an array, making them on first use.
+        """
+        if self._values is None:
+            shape = self.shape[::-1] if self.transposed else self.shape
+            if self.factors is not None:
+                A, B = self.factors
+                values = np.dot(np.asarray(A), np.asarray(B))
+            else:
+                values = np.random.default_rng(self.seed).integers(0, 9, size=shape)
+            self._values = values.T if self.transposed else values
+        return self._values
+
+    def __array__(self, dtype=None, copy=None):
+        values = self.values()
+        return values if dtype is None else values.astype(dtype)
+
+    def __getitem__(self, index):
+        return self.values()[index]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'LazyMatrix(shape={self.shape})'
 
-from studenttest import StudentTest
 
 class MatrixMultiplyTest(StudentTest):
-    def __init__(self, max_streak=10, mode = 'shape_matching', visual = 'numerical'):
+    BANK_PARAMS = ['mode', 'visual', 'typesetter']
+
+    def __init__(self, max_streak=10, mode = 'shape_matching', visual = 'numerical', typesetter = 'latex', seed = None):
         """
         Two modes:
         - shape_matching: The user has to find which multiplication has matching shapes
@@ -25,26 +351,146 @@ class MatrixMultiplyTest(StudentTest):
         
         Two settings:
         - numerical: Matrices displayed with numerical values
-        - dot: Matrices displayed with dots"""
-        super().__init__(max_streak)
+        - dot: Matrices displayed with dots
+
+        Two typesetters:
+        - latex: Matrices typeset by LaTeX through matplotlib (needs a TeX install)
+        - pil: Matrices typeset directly with PIL, no LaTeX or matplotlib
+
+        seed: optional root seed for the random stream, see StudentTest"""
+        super().__init__(max_streak, seed)
         
         #Check for valid mode and visual settings
         if mode not in ['shape_matching', 'shape_calculation']:
             raise ValueError("Invalid mode. Choose 'shape_matching' or 'shape_calculation'")
         if visual not in ['numerical', 'dot']:
             raise ValueError("Invalid setting. Choose 'numerical' or 'dot'")
+        if typesetter not in ['latex', 'pil']:
+            raise ValueError("Invalid typesetter. Choose 'latex' or 'pil'")
         
 
         self.mode = mode
         self.visual = visual
+        self.typesetter = typesetter
 
     def generate_matrix_pair(self, m, n, p):
         """
         Generate a pair of random matrices with dimensions m x p and p x n.
+        They are LazyMatrix objects, their values are only made if they are shown.
+        """
+        return lazy_matrix_pair(int(self.rng.integers(2**63)), m, n, p)
+
+    def matrix_variation(self, A, B, index, transposed):
+        """
+        Returns one of the four ways of multiplying A and B used by shape_matching, see matrix_variation.
         """
-        A = np.random.randint(0, 9, size=(m, p))
-        B = np.random.randint(0, 9, size=(p, n))
-        return A, B
+        return matrix_variation(A, B, index, transposed)
+
+    def generate_batch(self, n):
+        """
+        Generate n matrix multiplication problems at once, as stacked arrays.
+        Like generate_problem, a batch holds no matrix values: only the dimensions from shape_table and the seeds
+        of LazyMatrix pairs (see lazy_matrix_pair), so nothing is allocated or multiplied until a question is shown.
+        Returns a dict with:
+        - 'descriptions': list of n problem descriptions
+        - 'dims': (n, 3) array of the dimensions m, n, p (A is m x p, B is p x n)
+        - 'seeds': (n,) array of the seeds of A and B
+        - 'transposed': (n, 2) array of display_A_transposed, display_B_transposed
+        shape_calculation adds:
+        - 'option_dims': (n, 4, 3) array of the (M, N, P) of every product. Option 0 is the right answer, A @ B.
+        - 'option_seeds': (n, 4) array of the seeds of the factors of every product, the first one is 'seeds'
+        shape_matching adds:
+        - 'variations': (n, 4, 2) array of (variation index, transposed) for matrix_variation. Option 0 is the right answer.
+        """
+        # One of the triples of distinct dimensions per problem
+        table = shape_table()
+        rows = self.rng.integers(len(table['dims']), size=n)
+        dims = table['dims'][rows]
+        seeds = self.rng.integers(2**63, size=n)
+
+        if self.mode == 'shape_matching':
+            transposed = self.rng.integers(0, 2, size=(n, 2)).astype(bool)
+        elif self.mode == 'shape_calculation':
+            transposed = np.zeros((n, 2), dtype=bool) # We want a valid multiplication
+
+        batch = {'dims': dims, 'seeds': seeds, 'transposed': transposed}
+
+        if self.mode == 'shape_calculation':
+            # Same candidate shapes as generate_wrong_answers, as (M, N, P) rows
+            options = table['distractor_dims'][rows]
+            chosen = np.argsort(self.rng.random((n, len(options[0]))), axis=1)[:, :3]
+            wrong_dims = np.take_along_axis(options, chosen[:, :, None], axis=1)
+
+            batch['option_dims'] = np.concatenate([dims[:, None], wrong_dims], axis=1)
+            batch['option_seeds'] = np.concatenate([seeds[:, None], self.rng.integers(2**63, size=(n, 3))], axis=1)
+
+        if self.mode == 'shape_matching':
+            # The valid multiplication first, then the invalid ones
+            variations = np.zeros((n, 4, 2), dtype=int)
+            variations[:, 0, 0] = table['right_index'][rows]
+            variations[:, 1:, 0] = table['wrong_indices'][rows]
+            variations[:, :, 1] = self.rng.integers(0, 2, size=(n, 4))
+            batch['variations'] = variations
+
+        batch['descriptions'] = [self.describe_problem(m, n_, p) for m, n_, p in dims.tolist()]
+
+        return batch
+
+    def batch_to_records(self, batch):
+        """
+        Pack a batch from generate_batch into fixed-size problem bank records, see problembank.
+        Values are stored in the smallest types that hold them exactly.
+        """
+        fields = [('dims', np.uint8, (3,)), ('seeds', np.uint64), ('transposed', bool, (2,))]
+        if self.mode == 'shape_calculation':
+            fields += [('option_dims', np.uint8, (4, 3)), ('option_seeds', np.uint64, (4,))]
+        if self.mode == 'shape_matching':
+            fields += [('variations', np.uint8, (4, 2))]
+
+        records = np.zeros(len(batch['dims']), dtype=fields)
+        for name in records.dtype.names:
+            records[name] = batch[name]
+        return records
+
+    def records_to_batch(self, records):
+        """
+        Unpack problem bank records from batch_to_records into a batch, as generate_batch returns it.
+        """
+        batch = {name: records[name].astype(bool if name == 'transposed' else int) for name in records.dtype.names}
+        batch['descriptions'] = [self.describe_problem(m, n, p) for m, n, p in batch['dims'].tolist()]
+        return batch
+
+    def load_batch_item(self, batch, i):
+        """
+        Make problem i of a batch from generate_batch the current problem.
+        """
+        A, B = lazy_matrix_pair(int(batch['seeds'][i]), *batch['dims'][i].tolist())
+        display_A_transposed, display_B_transposed = batch['transposed'][i].tolist()
+        self.problem = [batch['descriptions'][i], (A, B, display_A_transposed, display_B_transposed)]
+
+        if self.mode == 'shape_calculation':
+            # The right answer is the product of A and B themselves, the wrong ones of pairs of their own
+            answers = [LazyMatrix((A.shape[0], B.shape[1]), factors=(A, B))]
+            for (M, N, P), seed in zip(batch['option_dims'][i, 1:].tolist(), batch['option_seeds'][i, 1:].tolist()):
+                answers.append(LazyMatrix((M, N), factors=lazy_matrix_pair(seed, M, N, P)))
+
+        if self.mode == 'shape_matching':
+            answers = [self.matrix_variation(A, B, index, transposed)
+                       for index, transposed in batch['variations'][i].tolist()]
+
+        self.right_answer = answers[0]
+        self.wrong_answers = answers[1:]
+        self.session.correct = 0 # Unshuffled, so the right answer comes first
+        return self.problem
+
+    def describe_problem(self, m, n, p):
+        """
+        Returns the prompt for a problem with dimensions m, n, p.
+        """
+        if self.mode == 'shape_matching':
+            return f"Given the following matrices A ({m}x{n}) and B ({n}x{p}), find a valid matrix multiplication:"
+        elif self.mode == 'shape_calculation':
+            return f"Given the following matrices A ({m}x{n}) and B ({n}x{p}), choose the correct result, based on shape:"
 
     def generate_problem(self):
         """
@@ -52,30 +498,35 @@ class MatrixMultiplyTest(StudentTest):
         Returns a list containing the problem description and a tuple of matrices A and B.
         Also writes it to self.problem.
         """
-        # Generate distinct dimensions m, n, p
-        # Make sure they are DISTINCT.
-        
-        dimensions = random.sample(range(1, 6), 3)
-        m, n, p= dimensions
+        # Pick one of the triples of distinct dimensions m, n, p
+        table = shape_table()
+        m, n, p = table['dims'][self.rng.integers(len(table['dims']))].tolist()
 
         # Generate random matrices A and B
         A,B  = self.generate_matrix_pair(m, n, p)
 
         # Randomly determine whether to display transposed matrices
-        display_A_transposed = random.choice([True, False])
-        display_B_transposed = random.choice([True, False])
+        display_A_transposed = bool(self.rng.integers(2))
+        display_B_transposed = bool(self.rng.integers(2))
 
         # Generate the problem description
-        if self.mode == 'shape_matching':
-            problem_description = f"Given the following matrices A ({m}x{n}) and B ({n}x{p}), find a valid matrix multiplication:"
-        elif self.mode == 'shape_calculation':
-            problem_description = f"Given the following matrices A ({m}x{n}) and B ({n}x{p}), choose the correct result, based on shape:"
+        problem_description = self.describe_problem(m, n, p)
+        if self.mode == 'shape_calculation':
             display_A_transposed, display_B_transposed = False, False # We want a valid multiplication
 
         self.problem = [problem_description, (A, B, display_A_transposed, display_B_transposed)]
 
         return self.problem
 
+    def problem_row(self):
+        """
+        Returns the row of shape_table for the current problem.
+        """
+        A, B, _, _ = self.problem[1]
+        m, p = A.shape
+        n = B.shape[1]
+        return shape_table()['index'][(m, n, p)]
+
     def generate_right_answer(self):
         """
         Generate the right answer for the matrix multiplication problem.
@@ -84,37 +535,13 @@ class MatrixMultiplyTest(StudentTest):
         A, B, _, _ = self.problem[1]
 
         if self.mode == 'shape_calculation':
-            # Calculate the shape of the result
-            right_answer = np.dot(A, B)
+            # The product, only multiplied out if it is shown
+            right_answer = LazyMatrix((A.shape[0], B.shape[1]), factors=(A, B))
 
         if self.mode == 'shape_matching':
-    
-            # Generate four variations of matrix multiplication
-            variations = [
-                [A, B],
-                [A, B.T],
-                [B, A],
-                [A.T, B]
-            ]
-
-            transposed_variations = [
-                [B.T, A.T],
-                [B,   A.T],
-                [A.T, B.T],
-                [B.T, A]
-            ]
-
-            # Find the valid matrix multiplication
-            right_answer = None
-            for i in range(len(variations)):
-                display_transposed = random.choice([True, False])
-                variation = transposed_variations[i] if display_transposed else variations[i]
-                if variation[0].shape[1] == variation[1].shape[0]:
-                    right_answer = variation
-
-            if right_answer == None:
-                raise ValueError("No valid matrix multiplication found:", A.shape, B.shape)
-
+            # The valid way of multiplying, looked up in the table, displayed transposed or not at random
+            index = shape_table()['right_index'][self.problem_row()]
+            right_answer = self.matrix_variation(A, B, index, bool(self.rng.integers(2)))
 
         self.right_answer = right_answer
         return self.right_answer
@@ -125,49 +552,22 @@ class MatrixMultiplyTest(StudentTest):
         Returns a list of 3 wrong answers.
         """
         A, B, _, _ = self.problem[1]
-        wrong_answers = []
+        table = shape_table()
+        row = self.problem_row()
 
         if self.mode == 'shape_calculation':
-            # Calculate the shape of the result
-            m,p = A.shape 
-            p,n = B.shape
-
-            #Sample three elements
-            options = [(m,p,n),(n,p,m), (p,n,m), (p,m,n),(n,m,p), (p,p,m)]
-            selected_optionas = random.sample(options, 3)
-
-            for M,N,P in selected_optionas: #Generate two wrong answers
+            # Products with three of the wrong shapes from the table
+            options = table['distractor_dims'][row][self.rng.permutation(len(table['distractor_dims'][row]))[:3]]
+            wrong_answers = []
+            for M,N,P in options.tolist():
                 A,B = self.generate_matrix_pair(M,N,P)
-                wrong_answers.append(np.dot(A,B))
-            
-
-           
+                wrong_answers.append(LazyMatrix((M, N), factors=(A, B)))
 
         if self.mode == 'shape_matching':
-
-            # Generate four variations of matrix multiplication
-            variations = [
-                [A, B],
-                [A, B.T],
-                [B, A],
-                [A.T, B]
-            ]
-            transposed_variations = [
-                [B.T, A.T],
-                [B,   A.T],
-                [A.T, B.T],
-                [B.T, A]
-            ]
-
-            # Find the invalid matrix multiplications
-            
-            for i in range(len(variations)):
-                display_transposed = random.choice([True, False])
-                variation = transposed_variations[i] if display_transposed else variations[i]
-                #print(i)
-                #print(variation[0].shape, variation[1].shape)
-                if variation[0].shape[1] != variation[1].shape[0]:
-                    wrong_answers.append(variation)
+            # The three invalid ways of multiplying, each displayed transposed or not at random
+            indices = table['wrong_indices'][row]
+            transposed = self.rng.integers(0, 2, size=len(indices)).tolist()
+            wrong_answers = [self.matrix_variation(A, B, index, t) for index, t in zip(indices.tolist(), transposed)]
 
         self.wrong_answers = wrong_answers
 
@@ -187,11 +587,22 @@ class MatrixMultiplyTest(StudentTest):
         if self.visual == 'dot':
             matrix_latex = r'$\begin{bmatrix}'
             for i in range(matrix.shape[0]):
-                row = ' & '.join('\cdot' for x in matrix[i])
+                row = ' & '.join([r'\cdot'] * matrix.shape[1]) # Only the shape, no values needed
                 matrix_latex += row + r' \\ '
             matrix_latex += r'\end{bmatrix}$'
         return matrix_latex
 
+    def get_renderer(self):
+        """
+        Returns the renderer for self.typesetter used by render_problem/render_answer, building it on first use.
+        """
+        if self.renderer is None:
+            if self.typesetter == 'pil':
+                self.renderer = MatrixRasterRenderer(self.visual)
+            else:
+                self.renderer = MatrixMultiplyRenderer(self.latex_matrix)
+        return self.renderer
+
     def render_problem(self):
         """
         Render the matrix multiplication problem as an image.
@@ -203,76 +614,48 @@ class MatrixMultiplyTest(StudentTest):
         if display_B_transposed:
             B = B.T
 
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(3, 3))
-
-        # Generate LaTeX code for matrix A
-        matrix_a_latex = self.latex_matrix(A)
-
-        # Generate LaTeX code for matrix B
-        matrix_b_latex = self.latex_matrix(B)
-
-        # Render LaTeX equations
-        ax1.text(0.5, 0.5, matrix_a_latex, fontsize=20, ha='center', va='center')
-        ax1.set_title(f'Matrix A ({A.shape[0]}x{A.shape[1]})')
-        ax1.axis('off')
-
-        ax2.text(0.5, 0.5, matrix_b_latex, fontsize=20, ha='center', va='center')
-        ax2.set_title(f'Matrix B ({B.shape[0]}x{B.shape[1]})')
-        ax2.axis('off')
-
-        plt.tight_layout()
-        plt.savefig('matrix_multiplication_problem.png')
-        plt.close()
-        return Image.open('matrix_multiplication_problem.png')
-
+        return self.get_renderer().render_problem(A, B)
 
-
-    def render_answer(self, answer): #Currently not working
+    def answer_matrices(self, answer):
         """
-        Render the answer (two matrices side-by-side in multiplication) as an image.
-        Returns a PIL Image object representing the answer.
+        Returns the matrices shown for an answer: the pair of matrices, or the product.
         """
-        
-        fig, ax = plt.subplots(figsize=(3,3))
-        ax.axis('off')
-        
         if self.mode == 'shape_matching':
             A, B = answer
-            # Generate LaTeX code for matrix A
-            matrix_a_latex = self.latex_matrix(A)[:-1]
-            
-            # Generate LaTeX code for matrix B
-            matrix_b_latex = self.latex_matrix(B)[1:]
+            matrices = [A, B]
         
-        if self.mode == 'shape_calculation': # Use \cdot to indicate each number
+        if self.mode == 'shape_calculation':
             C = answer
-            # Generate LaTeX code for matrix C
-            matrix_a_latex = self.latex_matrix(C)
-            matrix_b_latex = ''
+            matrices = [C]
 
+        return matrices
 
-        # Render LaTeX equations
-        ax.text(0, 0.5, matrix_a_latex+matrix_b_latex, fontsize=20, va='center')
-        #ax.text(offset, 0.5, matrix_b_latex, fontsize=20, va='center')
-        
-        plt.tight_layout()
-        plt.savefig('matrix_multiplication_answer.png')
-        plt.close()
-        
-        return Image.open('matrix_multiplication_answer.png')
+    def render_answer(self, answer):
+        """
+        Render the answer (two matrices side-by-side in multiplication, or the product) as an image.
+        Returns a PIL Image object representing the answer.
+        """
+        return self.get_renderer().render_answer(self.answer_matrices(answer))
+
+    def render_answers(self, answers):
+        """
+        Render several answers at once, see StudentTest.render_answers.
+        """
+        return self.get_renderer().render_answers([self.answer_matrices(answer) for answer in answers])
     
     
     def is_correct(self, answer):
         """
         Check if the given answer is correct.
         Returns True if the answer is correct, False otherwise.
+        In both modes the right answer is the only one with its shapes, so only shapes are compared.
         """
         if self.mode == 'shape_matching':
             Aright, Bright = self.right_answer
             A, B = answer
-            return np.array_equal(Aright, A) and np.array_equal(Bright, B)
+            return A.shape == Aright.shape and B.shape == Bright.shape
         if self.mode == 'shape_calculation':
-            return np.array_equal(self.right_answer, answer)
+            return answer.shape == self.right_answer.shape
     
 if __name__ == '__main__':
     # Create an instance of the ConvolutionTest class
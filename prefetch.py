@@ -0,0 +1,55 @@
+import queue
+import threading
+
+
+class QuestionPrefetcher:
+    """
+    Generates and renders questions ahead of time in worker threads, so they are ready when needed.
+    Each worker uses its own clone of the test, and at most size finished questions are kept waiting.
+    """
+    def __init__(self, test, size=2, workers=1):
+        self.questions = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self.work, args=(test.clone(),), daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self, test):
+        """
+        Worker loop: prepare questions and queue them until stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                question = test.prepare_question()
+            except Exception as error:
+                # Hand the error to whoever is waiting for a question, instead of dying silently
+                self.put(error)
+                return
+            self.put(question)
+
+    def put(self, item):
+        """
+        Queue an item, giving up when the prefetcher is stopped.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.questions.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, block=True, timeout=None):
+        """
+        Returns the next prepared question, see StudentTest.prepare_question.
+        Raises queue.Empty if none is ready within timeout (or right now, if block is False).
+        """
+        question = self.questions.get(block, timeout)
+        if isinstance(question, Exception):
+            raise question
+        return question
+
+    def stop(self):
+        """
+        Stop the workers. Questions that are still being prepared are thrown away.
+        """
+        self.stopped.set()
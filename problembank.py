@@ -0,0 +1,220 @@
+"""
+Problem banks: questions generated (and optionally rendered) ahead of time and stored on disk.
+
+A bank is a directory of shards. Each shard holds
+- shard-NNNNN.records.npy: a structured array of fixed-size records, one per question, with the problem
+  and option arrays from the test's batch_to_records, plus
+  - 'order': the order the options are shown in (option 0 is the right answer)
+  - 'correct': the position of the right answer in that order
+- shard-NNNNN.images.npy and shard-NNNNN.image_index.npy (optional): PNG bytes of the problem and the
+  options in display order, and an (n, 5, 2) array of (offset, length) into them
+
+Shards are memory-mapped when read, so opening a bank is instant however large it is. Shard files are written
+under temporary names and moved in place with the records last, so a shard's records always match its images.
+"""
+import glob
+import json
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+def encode_png(image):
+    """
+    Returns a PIL Image encoded as PNG bytes.
+    """
+    buffer = BytesIO()
+    image.save(buffer, format='png')
+    return buffer.getvalue()
+
+
+def save_temporary_npy(path, array):
+    """
+    Save an array with np.save under a temporary name next to path. Returns that name, to os.replace it in later.
+    """
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        np.save(f, array)
+    return temporary_path
+
+
+def shard_path(path, shard):
+    """
+    Returns the path of a shard, without the .records.npy/.images.npy/... suffix.
+    """
+    return os.path.join(path, f'shard-{shard:05d}')
+
+
+def write_shard(test, path, shard, n, render=False):
+    """
+    Generate n questions with test.generate_batch and write them as shard number shard of the bank at path.
+    With render, the images of every question are rendered and stored too.
+    """
+    batch = test.generate_batch(n)
+    base_records = test.batch_to_records(batch)
+
+    # Shuffle the options of every question once, and remember where the right answer went
+    order = np.argsort(test.rng.random((n, 4)), axis=1)
+    records = np.zeros(n, dtype=base_records.dtype.descr + [('order', np.uint8, (4,)), ('correct', np.uint8)])
+    for name in base_records.dtype.names:
+        records[name] = base_records[name]
+    records['order'] = order
+    records['correct'] = np.argmax(order == 0, axis=1)
+
+    # Every file is written under a temporary name first
+    base = shard_path(path, shard)
+    files = []
+    if render:
+        blobs = []
+        image_index = np.zeros((n, 5, 2), dtype=np.int64)
+        offset = 0
+        for i in range(n):
+            test.load_batch_item(batch, i)
+            answers = [test.right_answer] + test.wrong_answers
+            images = [test.render_problem()] + test.render_answers([answers[j] for j in order[i]])
+            for j, image in enumerate(images):
+                blob = encode_png(image)
+                image_index[i, j] = offset, len(blob)
+                blobs.append(blob)
+                offset += len(blob)
+        files.append((save_temporary_npy(base + '.images.npy', np.frombuffer(b''.join(blobs), dtype=np.uint8)),
+                      base + '.images.npy'))
+        files.append((save_temporary_npy(base + '.image_index.npy', image_index), base + '.image_index.npy'))
+    records_path = base + '.records.npy'
+    files.append((save_temporary_npy(records_path, records), records_path))
+
+    # Then moved in place with the records last: a shard only counts as written once they exist.
+    # The old records of a shard that is written again go first, so they are never next to the new images,
+    # and an interrupted rewrite leaves the shard missing rather than mixed
+    if os.path.exists(records_path):
+        os.remove(records_path)
+    for temporary_path, final_path in files:
+        os.replace(temporary_path, final_path)
+
+
+def write_info(test, path, **extra):
+    """
+    Write bank.json, which says what kind of questions the bank at path holds: the test class and its
+    bank_params. extra entries are stored with it.
+    """
+    with open(os.path.join(path, 'bank.json'), 'w') as f:
+        json.dump({'test': type(test).__name__, 'params': test.bank_params(), **extra}, f)
+
+
+def check_info(info, test):
+    """
+    Raise a ValueError if the bank described by info (from read_info) holds other questions than test makes.
+    """
+    if info['test'] != type(test).__name__:
+        raise ValueError(f"Bank holds {info['test']} questions, not {type(test).__name__} ones")
+    params = test.bank_params()
+    mismatched = [name for name in params if info['params'].get(name) != params[name]]
+    if mismatched:
+        raise ValueError(f"Bank holds {info['test']} questions made with different {', '.join(mismatched)}: "
+                         + ', '.join(f'{name}={info["params"].get(name)!r}' for name in mismatched))
+
+
+def read_info(path):
+    """
+    Returns the contents of bank.json of the bank at path, or None if there is none yet.
+    """
+    try:
+        with open(os.path.join(path, 'bank.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_bank(test, path, n, shard_size=10000, render=False):
+    """
+    Generate n questions with test and write them as a problem bank at path, in shards of shard_size.
+    """
+    os.makedirs(path, exist_ok=True)
+    write_info(test, path)
+
+    for shard, start in enumerate(range(0, n, shard_size)):
+        write_shard(test, path, shard, min(shard_size, n - start), render=render)
+
+
+class ProblemBank:
+    """
+    Read access to a problem bank written by write_bank. The shards are memory-mapped.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.info = read_info(path)
+        if self.info is None:
+            raise FileNotFoundError(f"No problem bank at {path}")
+
+        self.records = []
+        self.images = []
+        self.image_index = []
+        for records_path in sorted(glob.glob(os.path.join(path, 'shard-*.records.npy'))):
+            base = records_path[:-len('.records.npy')]
+            self.records.append(np.load(records_path, mmap_mode='r'))
+            if os.path.exists(base + '.images.npy'):
+                self.images.append(np.load(base + '.images.npy', mmap_mode='r'))
+                self.image_index.append(np.load(base + '.image_index.npy', mmap_mode='r'))
+                if len(self.image_index[-1]) != len(self.records[-1]):
+                    raise ValueError(f"{base} was written again while the bank was opened, open it again")
+            else:
+                self.images.append(None)
+                self.image_index.append(None)
+
+        # Index of the first question of every shard
+        self.starts = np.cumsum([0] + [len(records) for records in self.records])
+        if len(self) == 0:
+            raise ValueError(f"The problem bank at {path} holds no questions yet")
+
+    def __getstate__(self):
+        # Memory maps don't travel to other processes, reopen the bank there instead
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def locate(self, i):
+        """
+        Returns (shard, row) of question i.
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(f"Question {i} is not in a bank of {len(self)} questions")
+        shard = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return shard, i - int(self.starts[shard])
+
+    def question(self, test, i):
+        """
+        Returns question i as a dict like StudentTest.prepare_question, with an extra 'correct' entry:
+        the position of the right answer in 'answers'. Also makes it test's current question.
+        Images are decoded from the bank if it has them, otherwise rendered with test.
+        Raises ValueError if test makes other questions than the bank holds, see check_info.
+        """
+        check_info(self.info, test)
+
+        shard, row = self.locate(i)
+        records = self.records[shard][row:row + 1]
+        test.load_batch_item(test.records_to_batch(records), 0)
+
+        options = [test.right_answer] + test.wrong_answers
+        answers = [options[j] for j in records['order'][0]]
+
+        if self.images[shard] is not None:
+            images = [Image.open(BytesIO(self.images[shard][offset:offset + length]))
+                      for offset, length in self.image_index[shard][row]]
+        else:
+            images = [test.render_problem()] + test.render_answers(answers)
+
+        return {
+            'problem': test.problem,
+            'right_answer': test.right_answer,
+            'wrong_answers': test.wrong_answers,
+            'answers': answers,
+            'correct': int(records['correct'][0]),
+            'problem_image': images[0],
+            'answer_images': images[1:],
+        }
@@ -0,0 +1,106 @@
+"""
+Drawing helpers that only use NumPy and PIL, for render backends that skip matplotlib.
+"""
+import numpy as np
+from PIL import Image, ImageFont
+
+
+def load_font(size):
+    """
+    Returns DejaVu Sans (matplotlib's default font) at the given pixel size,
+    or PIL's built-in font if DejaVu Sans is not installed.
+    """
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def normalize_gray(array, vmin, vmax):
+    """
+    Map array to 0-255 grays the way matplotlib's 'gray' colormap does with the given vmin/vmax.
+    """
+    if vmax == vmin:
+        return np.zeros(array.shape, dtype=np.uint8)  # matplotlib shows a flat image as black
+    scaled = (np.asarray(array, dtype=float) - vmin) / (vmax - vmin)
+    return np.clip(scaled * 256, 0, 255).astype(np.uint8)
+
+
+def upscale_nearest(array, size):
+    """
+    Nearest-neighbour upscale of a 2D array to size x size pixels.
+    Each entry is repeated as evenly as possible when size is not a multiple of the array size.
+    """
+    row_counts = np.diff(np.arange(array.shape[0] + 1) * size // array.shape[0])
+    col_counts = np.diff(np.arange(array.shape[1] + 1) * size // array.shape[1])
+    return np.repeat(np.repeat(array, row_counts, axis=0), col_counts, axis=1)
+
+
+def bordered_panel(array, size, vmin, vmax, border=2):
+    """
+    Returns a size x size uint8 grayscale panel of array, with a black border of border pixels.
+    """
+    inner = upscale_nearest(normalize_gray(array, vmin, vmax), size - 2 * border)
+    return np.pad(inner, border, constant_values=0)
+
+
+def atlas_tiles(atlas, count):
+    """
+    Split an atlas, a grayscale (height, width) or RGBA (height, width, 4) uint8 array of count equally tall
+    tiles stacked top to bottom, into count PIL Images.
+    Each tile is a block of whole rows, so the Images are read-only views of atlas and nothing is copied.
+    """
+    atlas = np.ascontiguousarray(atlas)
+    mode = 'L' if atlas.ndim == 2 else 'RGBA'
+    height = atlas.shape[0] // count
+    return [Image.frombuffer(mode, (atlas.shape[1], height), atlas[i * height:(i + 1) * height], 'raw', mode, 0, 1)
+            for i in range(count)]
+
+
+def format_matrix(matrix, visual):
+    """
+    Returns the entries of a matrix as rows of strings: the numbers for 'numerical', a centered dot for 'dot'.
+    """
+    rows, cols = matrix.shape
+    if visual == 'dot':
+        return [['·'] * cols for _ in range(rows)]
+    return [[str(x) for x in row] for row in np.asarray(matrix).tolist()]
+
+
+def bracket_matrix_layout(entries, font):
+    """
+    Returns (width, height, column widths) of entries typeset as a bracket matrix with font.
+    """
+    size = font.size
+    column_widths = [max(font.getlength(row[j]) for row in entries) for j in range(len(entries[0]))]
+    width = sum(column_widths) + 0.7 * size * (len(column_widths) - 1) + 2 * 0.55 * size
+    height = 1.25 * size * len(entries) + 0.2 * size
+    return int(np.ceil(width)), int(np.ceil(height)), column_widths
+
+
+def draw_bracket_matrix(draw, entries, font, left, top):
+    """
+    Typeset entries as a matrix in square brackets, with its top left corner at (left, top).
+    Returns the width of the matrix.
+    """
+    size = font.size
+    width, height, column_widths = bracket_matrix_layout(entries, font)
+    line_width = max(1, size // 14)
+    tick = 0.25 * size
+
+    # Brackets: a vertical line with short ticks at both ends
+    right = left + width - 1
+    bottom = top + height - 1
+    draw.line([(left + tick, top), (left, top), (left, bottom), (left + tick, bottom)], fill=0, width=line_width)
+    draw.line([(right - tick, top), (right, top), (right, bottom), (right - tick, bottom)], fill=0, width=line_width)
+
+    # Entries, centered in their cells
+    row_height = 1.25 * size
+    for i, row in enumerate(entries):
+        x = left + 0.55 * size
+        y = top + 0.1 * size + row_height * (i + 0.5)
+        for entry, column_width in zip(row, column_widths):
+            draw.text((x + column_width / 2, y), entry, fill=0, font=font, anchor='mm')
+            x += column_width + 0.7 * size
+
+    return width
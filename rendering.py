@@ -0,0 +1,40 @@
+import numpy as np
+from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+class FigureBlitter:
+    """
+    Renders a figure that is reused between questions.
+    Everything except the given artists (axes, titles, ...) is drawn once and kept as a background,
+    later renders restore the background and only draw the artists again, in order.
+    """
+    def __init__(self, fig, artists):
+        self.fig = fig
+        self.canvas = fig.canvas if isinstance(fig.canvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
+        self.artists = artists
+        self.background = None
+
+    def render(self):
+        """
+        Returns the current state of the figure as a PIL Image.
+        """
+        return Image.fromarray(self.render_array())
+
+    def render_array(self):
+        """
+        Returns the current state of the figure as a (height, width, 4) RGBA array, copied out of the canvas.
+        """
+        if self.background is None:
+            for artist in self.artists:
+                artist.set_visible(False)
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+            for artist in self.artists:
+                artist.set_visible(True)
+
+        self.canvas.restore_region(self.background)
+        for artist in self.artists:
+            self.fig.draw_artist(artist)
+
+        return np.array(self.canvas.buffer_rgba())
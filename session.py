@@ -0,0 +1,44 @@
+"""
+Per-learner quiz state, kept apart from the tests that generate and render questions.
+
+A Session is a few numbers: the seed of the learner's question stream, the id of the current question,
+the position of its right answer and the streak. The question itself is never stored: it is
+regenerated from (seed, question id) when needed, see StudentTest.seeded_question.
+So one process can keep a very large number of sessions, while a handful of tests serve all of them.
+"""
+import secrets
+
+
+class Session:
+    """
+    Quiz state of one learner.
+    seed: integer seed of the learner's questions; a random one if not given.
+    """
+    __slots__ = ('seed', 'question_id', 'correct', 'streak')
+
+    def __init__(self, seed=None):
+        self.seed = secrets.randbits(63) if seed is None else int(seed)
+        self.question_id = 0
+        self.correct = None  # Position of the right answer in the current question, None once answered
+        self.streak = 0
+
+    def next_question(self):
+        """
+        Move on to a new question. Returns its id.
+        """
+        self.question_id += 1
+        self.correct = None
+        return self.question_id
+
+    def answer(self, index):
+        """
+        Answer the current question with the option at position index, and update the streak.
+        Returns True if it was the right answer.
+        """
+        correct = index == self.correct
+        self.streak = self.streak + 1 if correct else 0
+        self.correct = None
+        return correct
+
+    def __repr__(self):
+        return f'Session(seed={self.seed}, question_id={self.question_id}, correct={self.correct}, streak={self.streak})'
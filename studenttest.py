@@ -1,30 +1,52 @@
 
 
 import numpy as np
-import random
-import matplotlib.pyplot as plt
-from scipy.signal import convolve2d
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
-from time import time
+# tkinter is only imported by display_test, so generating questions headless never loads it
 
+from prefetch import QuestionPrefetcher
+from problembank import ProblemBank
+from session import Session
+from instrumentation import timer
 
-import tkinter as tk
-from PIL import ImageTk, Image
-import random
-import matplotlib.patches as patches
-from collections import Counter
+POLL_INTERVAL_MS = 15 # How often display_test checks whether the next question is ready
 
 
 
 class StudentTest:
-    def __init__(self, max_streak=10):
+    # Constructor parameters that change the questions of a problem bank: its records, or its images
+    # when they are rendered. They are stored with the bank and have to match to use it, see bank_params
+    BANK_PARAMS = ['mode']
+
+    def __init__(self, max_streak=10, seed=None):
+        """seed: optional root seed (an int or a np.random.SeedSequence) for this test's random stream.
+        Without one, the stream is seeded from fresh OS entropy."""
         self.problem = None
         self.right_answer = None
         self.wrong_answers = None
-        self.streak = 0
         self.max_streak=max_streak
 
-        self.image_num = 0 #Used for random seed purposes
+        # Every test owns its random stream, so tests never share global random state.
+        # Clones get independent child streams split off with SeedSequence.spawn.
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = seed
+        self.rng = np.random.default_rng(seed)
+        self.renderer = None # Built on first render by subclasses, see get_renderer
+        self.bank = None # Optional ProblemBank that prepare_question serves questions from
+        self.session = Session(self.seed_sequence.generate_state(1)[0]) # Quiz state of the learner in display_test
+        self.metrics = None # Optional instrumentation.MetricsRegistry that times every stage of a question
+
+    @property
+    def streak(self):
+        """The streak of self.session"""
+        return self.session.streak
+
+    @streak.setter
+    def streak(self, value):
+        self.session.streak = value
 
     def generate_problem(self):
         """Returns a list containing [description of problem/prompt as a string, internal representation of problem].
@@ -48,88 +70,260 @@ class StudentTest:
     def render_answer(self):
         """Create an image of the problem"""
         raise NotImplementedError  #Template class
+
+    def render_answers(self, answers):
+        """Returns images of several answers, the same as render_answer on each of them.
+        Subclasses can override this to draw all the answers in one go."""
+        return [self.render_answer(answer) for answer in answers]
     
     def is_correct(self, answer):
         """Returns True if the answer is correct, False otherwise
         Depends on the internal representation of the answer"""
         raise NotImplementedError
 
-    def display_test(self, reset=True):
+    def bank_params(self):
+        """Returns a dict of the BANK_PARAMS of this test and their values"""
+        return {name: getattr(self, name, None) for name in self.BANK_PARAMS}
+
+    def timer(self, stage):
+        """Returns a context manager that times stage into self.metrics (a no-op without metrics)"""
+        return timer(self.metrics, type(self).__name__, stage)
+
+    def clone(self):
+        """Returns a copy of this test that generates and renders questions on its own,
+        for example in a worker thread. The copy starts without a current question or renderer,
+        and with its own random stream spawned from this test's seed."""
+        test = copy.copy(self)
+        test.seed_sequence = self.seed_sequence.spawn(1)[0]
+        test.rng = np.random.default_rng(test.seed_sequence)
+        test.problem = None
+        test.right_answer = None
+        test.wrong_answers = None
+        test.renderer = None
+        test.session = Session(test.seed_sequence.generate_state(1)[0])
+        return test
+
+    def spawn(self, n):
+        """Returns n clones with independent random streams, for example one per worker process.
+        With a root seed, the whole set of streams is reproducible."""
+        return [self.clone() for _ in range(n)]
+
+    def prepare_question(self):
+        """Generate a new question and render everything needed to show it.
+        Returns a dict with:
+        - 'problem', 'right_answer', 'wrong_answers': as saved on self by the generate_* methods
+        - 'answers': the right and wrong answers, shuffled
+        - 'correct': the position of the right answer in 'answers'
+        - 'problem_image': PIL Image from render_problem
+        - 'answer_images': PIL Images from render_answers, in the same order as 'answers'
+        If self.bank is set, a random question from the bank is returned instead."""
+        if self.bank is not None:
+            with self.timer('load_from_bank'):
+                return self.bank.question(self, int(self.rng.integers(len(self.bank))))
+
+        with self.timer('generate_problem'):
+            self.generate_problem()
+        with self.timer('generate_right_answer'):
+            self.generate_right_answer()
+        with self.timer('generate_wrong_answers'):
+            self.generate_wrong_answers()
+
+        # Combine the right answer and wrong answers, and shuffle them randomly
+        answers = [self.right_answer] + self.wrong_answers
+        order = self.rng.permutation(len(answers))
+        answers = [answers[i] for i in order]
+
+        with self.timer('render_problem'):
+            problem_image = self.render_problem()
+        with self.timer('render_answers'):
+            answer_images = self.render_answers(answers)
+
+        return {
+            'problem': self.problem,
+            'right_answer': self.right_answer,
+            'wrong_answers': self.wrong_answers,
+            'answers': answers,
+            'correct': int(np.argmin(order)),
+            'problem_image': problem_image,
+            'answer_images': answer_images,
+        }
+
+    def seeded_question(self, seed, question_id):
+        """Prepare question number question_id of the question stream with the given integer seed,
+        like prepare_question. The same seed and question_id always give the same question,
+        so a question never has to be kept around to be shown again or checked."""
+        rng = self.rng
+        self.rng = np.random.default_rng([seed, question_id])
+        try:
+            return self.prepare_question()
+        finally:
+            self.rng = rng
+
+    def load_question(self, question):
+        """Make a question from prepare_question the current question."""
+        self.problem = question['problem']
+        self.right_answer = question['right_answer']
+        self.wrong_answers = question['wrong_answers']
+        self.session.correct = question['correct']
+        return self.problem
+
+    def generate_batch(self, n):
+        """Generate n problems at once, without touching self.problem/self.right_answer/self.wrong_answers.
+        Returns a dict with:
+        - 'descriptions': list of n prompts
+        - 'problems': list of n internal representations of problems
+        - 'options': list of n answer lists. Option 0 is the right answer, the rest are the wrong answers.
+        Subclasses can override this with a vectorized version that stacks the problems into arrays."""
+        problem, right_answer, wrong_answers = self.problem, self.right_answer, self.wrong_answers
+
+        descriptions, problems, options = [], [], []
+        for _ in range(n):
+            description, internal = self.generate_problem()
+            descriptions.append(description)
+            problems.append(internal)
+            options.append([self.generate_right_answer()] + self.generate_wrong_answers())
+
+        # Leave the current question alone
+        self.problem, self.right_answer, self.wrong_answers = problem, right_answer, wrong_answers
+
+        return {'descriptions': descriptions, 'problems': problems, 'options': options}
+
+    def load_batch_item(self, batch, i):
+        """Make question i of a batch from generate_batch the current question.
+        Sets self.problem, self.right_answer and self.wrong_answers, so render_problem/render_answer can be used on it."""
+        self.problem = [batch['descriptions'][i], batch['problems'][i]]
+        self.right_answer = batch['options'][i][0]
+        self.wrong_answers = list(batch['options'][i][1:])
+        self.session.correct = 0 # Unshuffled, so the right answer comes first
+        return self.problem
+
+    def batch_to_records(self, batch):
+        """Pack a batch from generate_batch into a structured array of fixed-size records, for a ProblemBank.
+        Depends on the internal representation of the problems"""
+        raise NotImplementedError
+
+    def records_to_batch(self, records):
+        """Unpack records from batch_to_records into a batch, as generate_batch returns it.
+        Depends on the internal representation of the problems"""
+        raise NotImplementedError
+
+    def display_test(self, reset=True, prefetch=0, workers=1, bank=None):
+        """Show the test in a Tk window.
+        Questions are prepared in a worker thread, and the window polls for them with root.after,
+        so it keeps repainting and reacting while the next question is on its way.
+        With prefetch > 0, up to that many questions are generated and rendered ahead of time
+        by worker threads, so "Next" shows a ready question right away.
+        With a bank (a ProblemBank or the path of one), questions are served from the bank
+        instead of being generated, and only rendered if the bank has no images."""
+        import queue
+        import tkinter as tk
+        from PIL import ImageTk
+
         # Create the main window
         root = tk.Tk()
         root.title("Student Test")
 
+        if bank is not None:
+            self.bank = bank if isinstance(bank, ProblemBank) else ProblemBank(bank)
+
         if reset:
             self.streak=0
+
+        prefetcher = None
+        executor = None
+        if prefetch > 0:
+            prefetcher = QuestionPrefetcher(self, size=prefetch, workers=workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=1)
+        pending = []  # Future of the question being prepared, without a prefetcher
+
+        def request_question():
+            # Start preparing a question (unless the prefetcher already is), and check back for it
+            if prefetcher is None:
+                pending.append(executor.submit(self.prepare_question))
+            root.after(POLL_INTERVAL_MS, poll_question)
+
+        def ready_question():
+            # Returns the next question if it is ready, None otherwise
+            if prefetcher is not None:
+                try:
+                    return prefetcher.get(block=False)
+                except queue.Empty:
+                    return None
+            if not pending[0].done():
+                return None
+            return pending.pop().result()
+
+        def poll_question():
+            question = ready_question()
+            if question is None:
+                root.after(POLL_INTERVAL_MS, poll_question)
+                return
+            self.load_question(question)
+            with self.timer('ui_update'):
+                show_question(question)
+
+        photos = {}  # Widget -> the PhotoImage it shows, reused for every question
+
+        def show_image(widget, image):
+            # Paste the image into the widget's PhotoImage, only making a new one if the size changed
+            with self.timer('photo_image'):
+                photo = photos.get(widget)
+                if photo is None or (photo.width(), photo.height()) != image.size:
+                    photo = photos[widget] = ImageTk.PhotoImage(image)  # Keeping it in photos prevents garbage collection
+                    widget.config(image=photo)
+                else:
+                    photo.paste(image)
         
-        # Function to check the selected answer and update the result label
-        def check_answer(selected_answer):
-            if self.is_correct(selected_answer):
+        # Function to check the selected answer (by its position) and update the result label
+        def check_answer(index):
+            correct_button = answer_buttons[self.session.correct]
+            if self.session.answer(index):
                 result_label.config(text="Correct!", fg="green", font=("Arial", 36))
-                self.streak += 1
             else:
                 result_label.config(text="Incorrect!", fg="red", font=("Arial", 36))
-                self.streak = 0
             
             # Disable answer buttons and highlight the correct answer
             for button in answer_buttons:
                 button.config(state=tk.DISABLED)
-                #Determine correct button
 
-            self.correct_button.config(bg="green")
+            correct_button.config(bg="green")
             
             # Show the "Next" button
             next_button.grid(row=2, column=3, padx=10, pady=10)
 
         def next_question():
-            # Clear the previous problem and answers
-
             if self.streak >= self.max_streak:
                 game_over()
 
-            prompt_label.config(text="")
-            problem_label.config(image=None)
-            result_label.config(text="")
-            for button in answer_buttons:
-                button.grid_forget()  # Hide the answer buttons instead of destroying them
+            # Clear the result, and wait for the next question without blocking the window
+            result_label.config(text="Loading...", fg="black", font=("Arial", 36))
             next_button.grid_forget()
-            
-            # Generate a new problem
-            self.generate_problem()
-            self.generate_right_answer()
-            self.generate_wrong_answers()
-            
+            request_question()
+
+        def show_question(question):
+            result_label.config(text="")
+
             # Update the prompt text
             prompt_label.config(text=self.problem[0])
             
-            # Render and update the problem image
-            problem_image = self.render_problem()
-            problem_photo = ImageTk.PhotoImage(problem_image)
-            problem_label.config(image=problem_photo)
-            problem_label.image = problem_photo  # Keep a reference to the photo to prevent garbage collection
-            
-            # Combine the right answer and wrong answers, and shuffle them randomly
-            answers = [self.right_answer] + self.wrong_answers
-            random.shuffle(answers)
+            # Update the problem image
+            show_image(problem_label, question['problem_image'])
             
             # Update the answer buttons with new images
-            for i, answer in enumerate(answers):
-                answer_image = self.render_answer(answer)
-                answer_photo = ImageTk.PhotoImage(answer_image)
-                answer_button = answer_buttons[i]
-                answer_button.config(image=answer_photo, state=tk.NORMAL, command=lambda a=answer: check_answer(a))
-                answer_button.image = answer_photo  # Keep a reference to the photo to prevent garbage collection
-                answer_button.grid(row=3, column=i, padx=10, pady=5)  # Show the answer buttons again
+            for i, answer_image in enumerate(question['answer_images']):
+                if i == len(answer_buttons):
+                    # First question: make the button
+                    answer_button = tk.Button(root, command=lambda i=i: check_answer(i))
+                    answer_button.grid(row=3, column=i, padx=10, pady=5)
+                    answer_buttons.append(answer_button)
+                show_image(answer_buttons[i], answer_image)
 
                 #Reset to background color
-                answer_button.config(bg=root.cget('bg'))
-
-                if np.array_equal(answer, self.right_answer):
-                    self.correct_button = answer_button
+                answer_buttons[i].config(state=tk.NORMAL, bg=root.cget('bg'))
             
             # Update the streak label
             streak_label.config(text=f"Streak: {self.streak}")
-            
         
         def game_over():
             # Create a popup window to congratulate the user
@@ -143,39 +337,19 @@ class StudentTest:
             
             self.streak=0
         
-        # Generate the problem, right answer, and wrong answers
-        self.generate_problem()
-        self.generate_right_answer()
-        self.generate_wrong_answers()
-        
         # Display the prompt text at the top
-        prompt_label = tk.Label(root, text=self.problem[0])
+        prompt_label = tk.Label(root, text="")
         prompt_label.grid(row=0, column=0, columnspan=2, padx=10, pady=10)
         
-        # Render and display the problem image on the top
-        problem_image = self.render_problem()
-        problem_photo = ImageTk.PhotoImage(problem_image)
-        problem_label = tk.Label(root, image=problem_photo)
+        # Display the problem image on the top
+        problem_label = tk.Label(root)
         problem_label.grid(row=1, column=1, columnspan=2, rowspan=2, padx=20, pady=10)
         
-        # Combine the right answer and wrong answers, and shuffle them randomly
-        answers = [self.right_answer] + self.wrong_answers
-        random.shuffle(answers)
-        
-        # Create clickable image buttons for each answer on the right
+        # Clickable image buttons for each answer, made when the first question arrives
         answer_buttons = []
-        for i, answer in enumerate(answers):
-            answer_image = self.render_answer(answer)
-            answer_photo = ImageTk.PhotoImage(answer_image)
-            answer_button = tk.Button(root, image=answer_photo, command=lambda a=answer: check_answer(a))
-            answer_button.grid(row=3, column=i, padx=10, pady=5)
-            answer_button.image = answer_photo  # Keep a reference to the photo to prevent garbage collection
-            answer_buttons.append(answer_button)
-            if self.is_correct(answer):
-                self.correct_button = answer_button
         
         # Create a label to display the result (correct/incorrect)
-        result_label = tk.Label(root, text="")
+        result_label = tk.Label(root, text="Loading...", font=("Arial", 36))
         result_label.grid(row=1, column=3, padx=20, pady=10)
         
         # Create a "Next" button
@@ -184,11 +358,23 @@ class StudentTest:
         # Create a label to display the streak in the corner
         streak_label = tk.Label(root, text=f"Streak: {self.streak}", bg="green")
         streak_label.grid(row=0, column=3, padx=10, pady=10, sticky="ne")
-        # Check if the streak reaches 10
-        
 
+        # Generate the problem, right answer, and wrong answers, and render them.
+        # This happens in the background while the window appears, and warms everything up for later questions:
+        # the heavy libraries get imported, and the renderer and font caches are built.
+        request_question()
         
         # Start the Tkinter event loop
         root.mainloop()
 
+        if prefetcher is not None:
+            prefetcher.stop()
+        if executor is not None:
+            executor.shutdown(wait=False)
+
 
+if __name__ == '__main__':
+    # python -m studenttest generate ..., see generate.py
+    import sys
+    from generate import main
+    sys.exit(main())
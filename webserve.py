@@ -0,0 +1,325 @@
+"""
+Serve a test over HTTP, as an alternative to the Tk window of StudentTest.display_test.
+One asyncio server handles many students at once; each client has a Session with its own questions and streak.
+Generating and rendering questions runs in a thread pool, so the event loop never waits on it.
+
+Endpoints:
+- GET /                                     a small page that plays the test in the browser
+- GET /question?client=ID                   a new question for the client, as JSON with the prompt and
+                                            the problem and answer images inlined as data: URIs
+- POST /answer?client=ID&question=N&answer=K
+                                            check answer K (a position in the answers) to question N,
+                                            returns JSON with the result, the right position and the streak
+A client without an ID gets a fresh one in the /question reply.
+"""
+import asyncio
+import json
+import secrets
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from export import data_uri
+from problembank import encode_png
+from session import Session
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 409: 'Conflict'}
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Student Test</title>
+<style>body{font-family:sans-serif;margin:2em} #answers{display:flex;gap:1em}
+#answers img{border:4px solid transparent;cursor:pointer} #result{font-size:200%}</style></head>
+<body><p id="streak"></p><h3 id="prompt"></h3><img id="problem">
+<div id="answers"></div><p id="result"></p><button id="next" hidden>Next</button>
+<script>
+let client = null, question = null, answered = false;
+async function next() {
+  const reply = await (await fetch('question' + (client ? '?client=' + client : ''))).json();
+  client = reply.client; question = reply.question; answered = false;
+  document.getElementById('prompt').textContent = reply.prompt;
+  document.getElementById('problem').src = reply.problem_image;
+  document.getElementById('streak').textContent = 'Streak: ' + reply.streak;
+  document.getElementById('result').textContent = '';
+  document.getElementById('next').hidden = true;
+  const answers = document.getElementById('answers');
+  answers.replaceChildren(...reply.answer_images.map((src, i) => {
+    const image = document.createElement('img');
+    image.src = src; image.onclick = () => answer(i);
+    return image;
+  }));
+}
+async function answer(i) {
+  if (answered) return;
+  answered = true;
+  const reply = await (await fetch(`answer?client=${client}&question=${question}&answer=${i}`, {method: 'POST'})).json();
+  const result = document.getElementById('result');
+  result.textContent = reply.correct ? 'Correct!' : 'Incorrect!';
+  result.style.color = reply.correct ? 'green' : 'red';
+  document.getElementById('answers').children[reply.right].style.borderColor = 'green';
+  document.getElementById('streak').textContent = 'Streak: ' + reply.streak;
+  if (reply.finished) result.textContent += ` You reached a streak of ${reply.max_streak}!`;
+  document.getElementById('next').hidden = false;
+}
+document.getElementById('next').onclick = next;
+next();
+</script></body></html>
+"""
+
+
+def prepare_web_question(test, seed, question_id):
+    """
+    Prepare question question_id of the stream with the given seed, and encode its images (run in a worker thread).
+    Returns the prompt, the images as data: URIs and the position of the right answer.
+    """
+    question = test.seeded_question(seed, question_id)
+    return {
+        'prompt': question['problem'][0],
+        'problem_image': data_uri(encode_png(question['problem_image'])),
+        'answer_images': [data_uri(encode_png(image)) for image in question['answer_images']],
+        'correct': question['correct'],
+    }
+
+
+class TestServer:
+    """
+    Serves a test to many clients over HTTP, see the module docstring for the endpoints.
+    workers: number of threads (each with its own clone of the test) that prepare questions.
+    max_clients: sessions remembered at once; the least recently seen ones are forgotten past that.
+    """
+    def __init__(self, test, workers=4, max_clients=100000):
+        self.test = test
+        self.max_streak = test.max_streak
+        self.max_clients = max_clients
+        self.sessions = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.tests = asyncio.Queue()
+        for clone in test.spawn(workers):
+            self.tests.put_nowait(clone)
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=8000):
+        """
+        Start listening. Returns the port, which is useful with port=0 (any free port).
+        """
+        self.server = await asyncio.start_server(self.handle_connection, host, port, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self, host='127.0.0.1', port=8000):
+        port = await self.start(host, port)
+        print(f"Serving on http://{host}:{port}/")
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+    async def prepare_question(self, seed, question_id):
+        """
+        Prepare a question in the thread pool, with whichever clone of the test is free.
+        """
+        test = await self.tests.get()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, prepare_web_question, test, seed, question_id)
+        finally:
+            self.tests.put_nowait(test)
+
+    def session(self, client_id):
+        """
+        Returns (id, session) of a client, making a new session if the id is missing or unknown.
+        """
+        if client_id is None or client_id not in self.sessions:
+            client_id = client_id or secrets.token_hex(8)
+            self.sessions[client_id] = Session()
+            if len(self.sessions) > self.max_clients:
+                self.sessions.popitem(last=False)
+        self.sessions.move_to_end(client_id)
+        return client_id, self.sessions[client_id]
+
+    async def new_question(self, params):
+        client_id, session = self.session(params.get('client'))
+        question_id = session.next_question()
+        question = await self.prepare_question(session.seed, question_id)
+
+        # The client may have asked for another question in the meantime
+        if session.question_id == question_id:
+            session.correct = question['correct']
+        return 200, {
+            'client': client_id,
+            'question': question_id,
+            'prompt': question['prompt'],
+            'problem_image': question['problem_image'],
+            'answer_images': question['answer_images'],
+            'streak': session.streak,
+        }
+
+    def check_answer(self, params):
+        client_id = params.get('client')
+        if client_id not in self.sessions:
+            return 404, {'error': 'unknown client'}
+        session = self.sessions[client_id]
+        try:
+            question, answer = int(params['question']), int(params['answer'])
+        except (KeyError, ValueError):
+            return 400, {'error': 'question and answer must be integers'}
+        if question != session.question_id or session.correct is None:
+            return 409, {'error': 'not the current question, or already answered'}
+
+        right = session.correct
+        correct = session.answer(answer)
+        reply = {'correct': correct, 'right': right, 'streak': session.streak,
+                 'finished': session.streak >= self.max_streak, 'max_streak': self.max_streak}
+        if reply['finished']:
+            session.streak = 0  # Start over, like game_over in display_test
+        return 200, reply
+
+    async def handle_request(self, method, target):
+        """
+        Returns (status, content type, body) for a request.
+        """
+        url = urlsplit(target)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        path = url.path.rstrip('/') or '/'
+
+        if path == '/':
+            return 200, 'text/html; charset=utf-8', PAGE.encode('utf-8')
+        if path == '/question' and method == 'GET':
+            status, reply = await self.new_question(params)
+        elif path == '/answer' and method == 'POST':
+            status, reply = self.check_answer(params)
+        elif path in ('/question', '/answer'):
+            status, reply = 405, {'error': 'method not allowed'}
+        else:
+            status, reply = 404, {'error': 'not found'}
+        return status, 'application/json', json.dumps(reply).encode('utf-8')
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answer HTTP/1.1 requests on one connection until the client closes it.
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length:
+                    await reader.readexactly(length)  # Everything we need is in the query string
+
+                status, content_type, body = await self.handle_request(method, target)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write(f'HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n'
+                             f'Content-Type: {content_type}\r\n'
+                             f'Content-Length: {len(body)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(test, host='127.0.0.1', port=8000, workers=4):
+    """
+    Serve test over HTTP until interrupted.
+    """
+    try:
+        asyncio.run(TestServer(test, workers=workers).serve_forever(host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+async def http_request(reader, writer, method, target):
+    """
+    Send one request on a keep-alive connection. Returns (status, decoded JSON body).
+    """
+    writer.write(f'{method} {target} HTTP/1.1\r\nHost: localhost\r\nContent-Length: 0\r\n\r\n'.encode('latin-1'))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def simulated_client(host, port, questions, rng, latencies):
+    """
+    One simulated student: fetch questions and answer each at random, timing every request.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    client = None
+    try:
+        for _ in range(questions):
+            start = time.perf_counter()
+            status, reply = await http_request(reader, writer, 'GET', '/question' + (f'?client={client}' if client else ''))
+            latencies.append(time.perf_counter() - start)
+            assert status == 200, reply
+            client = reply['client']
+
+            answer = int(rng.integers(len(reply['answer_images'])))
+            start = time.perf_counter()
+            status, reply = await http_request(reader, writer, 'POST',
+                                               f'/answer?client={client}&question={reply["question"]}&answer={answer}')
+            latencies.append(time.perf_counter() - start)
+            assert status == 200, reply
+    finally:
+        writer.close()
+
+
+async def simulate(host='127.0.0.1', port=8000, clients=200, questions=5, seed=None):
+    """
+    Load test a running server with many concurrent simulated clients.
+    Returns a dict with the number of requests, the total time and latency percentiles in milliseconds.
+    """
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(clients)]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(simulated_client(host, port, questions, rng, latencies) for rng in rngs))
+    elapsed = time.perf_counter() - start
+
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99]).tolist()
+    return {'requests': len(latencies), 'seconds': elapsed, 'requests_per_second': len(latencies) / elapsed,
+            'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+
+
+async def serve_and_simulate(test, clients=200, questions=5, workers=4):
+    """
+    Start a server for test on a free localhost port, run simulate against it, and shut it down.
+    """
+    server = TestServer(test, workers=workers)
+    port = await server.start('127.0.0.1', 0)
+    try:
+        return await simulate('127.0.0.1', port, clients=clients, questions=questions)
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+    from convolutiontest import ConvolutionTest
+
+    # Serve the dot convolution test on http://127.0.0.1:8000/
+    serve(ConvolutionTest(max_streak=3, mode='dot'))